@@ -3,30 +3,99 @@
 
 import os
 import re
+import hmac
+import hashlib
+import fcntl
+import gzip
+import shutil
+import tempfile
+import random
+import signal
 import peewee
-import requests
-from time import sleep
-from telebot import TeleBot
+import argparse
+import json
+import bisect
+import heapq
+import queue
+import logging
+import threading
+import urllib.error
+import urllib.request
+from functools import partial, lru_cache
+from itertools import chain
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from time import sleep, time, monotonic, perf_counter
 from datetime import datetime
-from fast_bitrix24 import Bitrix
 from urllib.parse import urlparse
 from playhouse.db_url import connect
+from playhouse.migrate import SchemaMigrator, migrate
 from configparser import ConfigParser
-from telebot.apihelper import ApiTelegramException
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Тяжёлые библиотеки (telebot, fast_bitrix24, aiohttp) загружаются при первом обращении:
+# запуск из cron, которому нечего делать, обходится без них (load_telebot, load_asyncio)
+TeleBot = types = apihelper = asyncio = aiohttp = None
+
+
+class ApiTelegramException(Exception):
+    """
+    Заменяется исключением telebot в load_telebot; до этого Телеграм не вызывается
+    """
 
 
 db_proxy = peewee.DatabaseProxy()
+# Строк на странице списочных методов REST Битрикс24
+BITRIX_PAGE_SIZE = 50
+# Команд в одном запросе batch
+BITRIX_BATCH_SIZE = 50
+# Предел длины текста сообщения Телеграма
+# https://core.telegram.org/bots/api#sendmessage
+TLGRM_MESSAGE_LIMIT = 4096
+# Бот может удалить сообщение в течение 48 часов после отправки, запас — на задержки доставки
+# https://core.telegram.org/bots/api#deletemessage
+TLGRM_DELETE_WINDOW = 48 * 3600
+TLGRM_DELETE_MARGIN = 600
+# Сколько сообщений удаляет один вызов deleteMessages
+TLGRM_DELETE_BATCH = 100
+# Символы, которые экранируются в MarkdownV2: https://core.telegram.org/bots/api#markdownv2-style
+MARKDOWNV2_SPECIAL = '_*[]()~`>#+-=|{}.!'
+MARKDOWNV2_ESCAPE = str.maketrans({symbol: '\\' + symbol for symbol in MARKDOWNV2_SPECIAL})
+# Сколько фрагментов с ответственным помнит MessageRenderer
+RESPONSIBLE_CACHE_SIZE = 4096
+EMOJI = {
+    'person': '\U0001F9D1',     # 🧑
+    'pin': '\U0001F4CC',        # 📌
+    'doc': '\U0001F4CB',        # 📋
+    'recycle': '\U0000267B',    # ♻
+    'category': '\U0001F4CE',   # 📎
+    'check': '\U00002705',      # ✅
+    'warning': '\U000026A0',    # ⚠️
+}
 
 
 def markdownv2_converter(text):
     """
-    Функция преобразует текст с учётом экранирования требуемых символов:
-    https://core.telegram.org/bots/api#markdownv2-style
+    Функция преобразует текст с учётом экранирования требуемых символов
+    (один проход по таблице MARKDOWNV2_ESCAPE)
+    """
+    return text.translate(MARKDOWNV2_ESCAPE)
+
+
+def tlgrm_length(text):
+    """
+    Длина текста так, как её считает Телеграм: в кодовых единицах UTF-16
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+
+def content_hash(deal, text):
+    """
+    Короткий хеш того, что видно в Телеграме: полей сделки, влияющих на сообщение, и текста
     """
-    symbols_for_replace = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for symbol in symbols_for_replace:
-        text = text.replace(symbol, '\\' + symbol)
-    return text
+    content = '\x1f'.join(str(value) for value in (deal.id, deal.category_id, deal.assigned_by_id, deal.title))
+    return hashlib.blake2b(f'{content}\x1e{text}'.encode(), digest_size=8).hexdigest()
 
 
 def str2bool(text):
@@ -36,29 +105,120 @@ def str2bool(text):
     return answer
 
 
+def load_telebot():
+    global TeleBot, types, apihelper, ApiTelegramException
+    from telebot import TeleBot, types, apihelper
+    from telebot.apihelper import ApiTelegramException
+
+
+def load_asyncio():
+    """
+    asyncio и aiohttp нужны только постоянным режимам (--daemon, --push, порталы)
+    """
+    global asyncio, aiohttp
+    import asyncio
+    import aiohttp
+    import aiohttp.web
+
+
 def check_online(url):
     """
     Функция проверяет доступность домена из ссылки
     """
     parsed_url = urlparse(url)
     base_url = '{uri.scheme}://{uri.netloc}/'.format(uri=parsed_url)
-    if requests.get(base_url).status_code == 200:
-        return True
-    else:
+    try:
+        with urllib.request.urlopen(base_url, timeout=15) as response:
+            return response.status == 200
+    except urllib.error.HTTPError:
         return False
 
 
-def dict_key_lower(dict_orig):
-    dict_lower = {}
-    for key in dict_orig.keys():
-        if key == 'DATE_CREATE':
-            date_time_str = dict_orig[key][0:18]
-            date_time_form = '%Y-%m-%dT%H:%M:%S'
-            date_time = datetime.strptime(date_time_str, date_time_form)
-            dict_lower[key.lower()] = date_time
-        else:
-            dict_lower[key.lower()] = dict_orig[key]
-    return dict_lower
+class HealthCache:
+    """
+    Успешные проверки доступности (портал, бот) запоминаются в файле на ttl секунд:
+    частые запуски из cron не проверяют одно и то же заново. Неудачные не запоминаются
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def read(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def probe(self, name, check):
+        # При записи/воспроизведении проверки тоже часть цикла
+        if self.ttl > 0 and capture is None and time() - self.read().get(name, 0) < self.ttl:
+            return True
+        result = check()
+        if result and self.ttl > 0:
+            with self.lock:
+                probes = self.read()
+                probes[name] = time()
+                with open(f'{self.path}.tmp', 'w') as file:
+                    json.dump(probes, file)
+                os.replace(f'{self.path}.tmp', self.path)
+        return result
+
+
+def idle_check(settings):
+    """
+    Дешёвая проверка перед однократным запуском в режиме incremental: полная сверка
+    и обновление справочников не подошли, в очереди нет операций к отправке, а в
+    Битрикс24 после прошлого цикла ничего не изменилось (одна страница, только ID).
+    Тогда цикл пропускается без загрузки клиентов Битрикс24 и Телеграма.
+    Удалённые сделки в этом случае находит полная сверка
+    """
+    if settings.sync_mode != 'incremental':
+        return False
+    now = time()
+    db = connect_db(settings.db_url, settings.sqlite_journal)
+    try:
+        models = bind_models(db)
+        sync_state, outbox, sweep = models['SyncState'], models['Outbox'], models['Sweep']
+        if not db.table_exists(sync_state._meta.table_name):
+            return False
+        state = {row.key: row.value for row in sync_state.select()}
+        if 'date_modify' not in state or 'date_modify_ids' not in state:
+            return False
+        if now - float(state.get('last_full_sync', 0)) >= settings.full_sync_interval:
+            return False
+        for kind, ttl in (
+            ('user', settings.users_ttl),
+            ('category', settings.categories_ttl),
+            ('department', settings.departments_ttl),
+        ):
+            if now - float(state.get(f'{kind}_updated', 0)) >= ttl:
+                return False
+        if outbox.select().where(outbox.next_attempt <= now).exists():
+            return False
+        if sweep.select().where(sweep.delete_at <= now).exists():
+            return False
+    finally:
+        db.close()
+    request = urllib.request.Request(
+        f'{settings.webhook.rstrip("/")}/crm.deal.list',
+        data=json.dumps({
+            'select': ['ID'],
+            # Сделки с той же секундой, что и отметка, уже видены прошлым циклом (date_modify_ids)
+            'filter': {'>=DATE_MODIFY': state['date_modify']},
+            'start': -1,
+        }).encode(),
+        headers={'Content-Type': 'application/json'},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=15) as response:
+            deals = json.load(response).get('result', [])
+    except (OSError, ValueError):
+        return False
+    ids_seen = set(filter(None, state['date_modify_ids'].split(',')))
+    return {str(deal['ID']) for deal in deals} <= ids_seen
 
 
 def read_id_list(file_with_list, pattern):
@@ -78,321 +238,2114 @@ def read_id_list(file_with_list, pattern):
         return telegram_id_list
 
 
-class BaseModel(peewee.Model):
-    class Meta:
-        database = db_proxy
+class NullMetrics:
+    """
+    Метрики выключены: пустые методы, чтобы не тратить время на учёт
+    """
+    enabled = False
+
+    def phase(self, name):
+        return nullcontext()
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def peak(self, name, value):
+        pass
+
+    def start_cycle(self, portal=None):
+        pass
+
+    def finish_cycle(self):
+        pass
+
+
+class Metrics(NullMetrics):
+    """
+    Метрики: длительность фаз цикла, счётчики (вызовы REST и Телеграма, ответы 429,
+    запросы к БД) и гистограммы задержек. Отдаются в формате Prometheus
+    и строкой JSON в конце каждого цикла
+    """
+    enabled = True
+    prefix = 'bitrix24telegram'
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, log_cycles=False):
+        self.log_cycles = log_cycles
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.phases = {}
+        self.peaks = {}
+        # Состояние цикла — своё у каждого потока: циклы разных порталов идут параллельно
+        self.cycle = threading.local()
+
+    @contextmanager
+    def phase(self, name):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            duration = perf_counter() - started
+            phases_cycle = getattr(self.cycle, 'phases', None)
+            with self.lock:
+                if phases_cycle is None:
+                    self.phases[name] = duration
+                else:
+                    phases_cycle[name] = phases_cycle.get(name, 0) + duration
+            self.count('phase_seconds_total', duration, phase=name)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = [[0] * len(self.buckets), 0, 0]
+            histogram = self.histograms[name]
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def peak(self, name, value):
+        """
+        Максимум величины с прошлого итога цикла (доставка в фоне идёт и между циклами)
+        """
+        with self.lock:
+            self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def start_cycle(self, portal=None):
+        with self.lock:
+            self.cycle.portal = portal
+            self.cycle.phases = {}
+            self.cycle.counters_start = dict(self.counters)
+            self.cycle.started = perf_counter()
+
+    def finish_cycle(self):
+        """
+        Итог цикла строкой JSON. Счётчики общие на процесс: при параллельных
+        циклах нескольких порталов в разницу попадают вызовы всех порталов
+        """
+        if getattr(self.cycle, 'started', None) is None:
+            return
+        self.count('cycles_total')
+        with self.lock:
+            summary = {
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'cycle_seconds': round(perf_counter() - self.cycle.started, 4),
+                'phases': {name: round(value, 4) for name, value in self.cycle.phases.items()},
+                'counters': {},
+            }
+            if self.cycle.portal is not None:
+                summary['portal'] = self.cycle.portal
+            if self.peaks:
+                summary['peaks'] = {name: round(value, 4) for name, value in self.peaks.items()}
+                self.peaks = {}
+            for (name, labels), value in self.counters.items():
+                if name == 'phase_seconds_total':
+                    continue
+                delta = value - self.cycle.counters_start.get((name, labels), 0)
+                if delta:
+                    label = ','.join(f'{key}={value}' for key, value in labels)
+                    summary['counters'][f'{name}{{{label}}}' if label else name] = round(delta, 4)
+            self.phases.update(self.cycle.phases)
+            self.cycle.started = None
+            self.cycle.phases = None
+        if self.log_cycles:
+            print(json.dumps(summary, ensure_ascii=False))
+        return summary
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            lines.append(f'# TYPE {self.prefix}_phase_last_seconds gauge')
+            for name, value in sorted(self.phases.items()):
+                lines.append(f'{self.prefix}_phase_last_seconds{{phase="{name}"}} {value}')
+            names_seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in names_seen:
+                    names_seen.add(name)
+                    lines.append(f'# TYPE {self.prefix}_{name} counter')
+                label = ','.join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f'{self.prefix}_{name}{{{label}}} {value}' if label else f'{self.prefix}_{name} {value}')
+            for name, (counts, total, number) in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {self.prefix}_{name} histogram')
+                for bucket, count in zip(self.buckets, counts):
+                    lines.append(f'{self.prefix}_{name}_bucket{{le="{bucket}"}} {count}')
+                lines.append(f'{self.prefix}_{name}_bucket{{le="+Inf"}} {number}')
+                lines.append(f'{self.prefix}_{name}_sum {total}')
+                lines.append(f'{self.prefix}_{name}_count {number}')
+        return '\n'.join(lines) + '\n'
+
+
+class QueryCounter(logging.Handler):
+    """
+    Считает запросы peewee к БД (peewee пишет каждый запрос в журнал на уровне DEBUG)
+    """
+
+    def emit(self, record):
+        metrics.count('db_queries_total')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+metrics = NullMetrics()
+
+
+def enable_metrics(settings):
+    """
+    Включает сбор метрик, если задан metrics_port или metrics_log
+    """
+    global metrics
+    if not (settings.metrics_port or settings.metrics_log) or metrics.enabled:
+        return
+    metrics = Metrics(log_cycles=settings.metrics_log)
+    peewee_logger = logging.getLogger('peewee')
+    peewee_logger.addHandler(QueryCounter())
+    peewee_logger.setLevel(logging.DEBUG)
+    peewee_logger.propagate = False
+    if settings.metrics_port:
+        server = ThreadingHTTPServer((settings.metrics_host, settings.metrics_port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+
+class Capture:
+    """
+    Запись ответов Битрикс24 и Телеграма за цикл и их воспроизведение без сети.
+    Файл — gzip, одна строка JSON на вызов: вид (bitrix/telegram), метод, аргументы,
+    результат или ошибка. Первая строка — настройки и списки ID на момент записи,
+    рядом (<файл>.db) — снимок БД SQLite до цикла. Токен бота, вебхук и
+    application_token заменяются на ***
+    """
+    redacted = '***'
+    replay_webhook = 'https://replay.invalid/rest/0/replay/'
+    replay_botid = '0:replay'
+
+    def __init__(self, path, replaying=False, secrets=()):
+        self.path = path
+        self.replaying = replaying
+        self.secrets = [secret for secret in secrets if secret]
+        self.lock = threading.Lock()
+        self.header = None
+        self.entries = {}
+        self.message_id = 0
+        self.file = None
+        self.work_dir = None
+        if not replaying:
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+            return
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            self.header = json.loads(next(file))
+            for line in file:
+                entry = json.loads(line)
+                self.entries.setdefault(self.key(entry['kind'], entry['method'], entry['args']), deque()).append(entry)
+
+    def redact(self, value):
+        if isinstance(value, str):
+            for secret in self.secrets:
+                value = value.replace(secret, self.redacted)
+            return value
+        if isinstance(value, dict):
+            return {key: self.redact(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.redact(item) for item in value]
+        return value
+
+    def key(self, kind, method, args):
+        return json.dumps([kind, method, args], ensure_ascii=False, sort_keys=True, default=str)
+
+    def write(self, entry):
+        line = json.dumps(self.redact(entry), ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def write_header(self, settings):
+        config = {section: dict(settings.config.items(section)) for section in settings.config.sections()}
+        lists = {}
+        for list_file in (settings.telegram_id_list_file, settings.category_id_list_file, settings.department_id_list_file):
+            if os.path.exists(list_file):
+                with open(list_file) as file:
+                    lists[os.path.basename(list_file)] = file.read()
+        self.write({'time': time(), 'config': config, 'lists': lists})
+
+    def snapshot(self, db):
+        if not isinstance(db, peewee.SqliteDatabase):
+            print('Снимок БД для воспроизведения делается только для SQLite')
+            return
+        if os.path.exists(f'{self.path}.db'):
+            os.remove(f'{self.path}.db')
+        db.execute_sql('VACUUM INTO ?', (f'{self.path}.db',))
+
+    def call(self, kind, method, func, args, kwargs):
+        call_args = json.loads(json.dumps(self.redact([args, kwargs]), default=str))
+        if self.replaying:
+            return self.replay(kind, method, call_args)
+        try:
+            result = func(*args, **kwargs)
+        except ApiTelegramException as exc:
+            self.write({'kind': kind, 'method': method, 'args': call_args, 'error': {'telegram': exc.result_json}})
+            raise
+        except Exception as exc:
+            self.write({'kind': kind, 'method': method, 'args': call_args, 'error': {'message': str(exc)}})
+            raise
+        if kind == 'telegram' and isinstance(result, types.JsonDeserializable):
+            # Объекты Bot API: Message хранит исходный JSON, User умеет to_dict
+            data = result.to_dict() if hasattr(result, 'to_dict') else result.json
+            self.write({'kind': kind, 'method': method, 'args': call_args, 'type': type(result).__name__, 'result': data})
+        else:
+            self.write({'kind': kind, 'method': method, 'args': call_args, 'result': result})
+        return result
+
+    def replay(self, kind, method, args):
+        with self.lock:
+            entries = self.entries.get(self.key(kind, method, args))
+            entry = entries.popleft() if entries else None
+            if entry is None and kind == 'telegram':
+                # Вызова при записи не было (например, по часам подошёл повтор) — ответ Телеграма придумываем
+                self.message_id += 1
+                message_id = self.message_id
+        if entry is None:
+            if kind != 'telegram':
+                raise ConnectionError(f'Нет записанного ответа: {kind} {method} {args}')
+            if method not in ('send_message', 'edit_message_text'):
+                return True
+            kwargs = args[1]
+            return types.Message.de_json({
+                'message_id': kwargs.get('message_id', message_id),
+                'date': int(time()),
+                'chat': {'id': kwargs.get('chat_id', 0), 'type': 'supergroup'},
+                'text': kwargs.get('text', ''),
+            })
+        error = entry.get('error')
+        if error is not None:
+            if 'telegram' in error:
+                raise ApiTelegramException(method, None, error['telegram'])
+            raise ConnectionError(error['message'])
+        if 'type' in entry:
+            return getattr(types, entry['type']).de_json(entry['result'])
+        return entry['result']
+
+    def replay_settings(self):
+        """
+        Рабочий каталог во временной папке: настройки и списки ID из записи,
+        копия снимка БД. Удаляется в close
+        """
+        work_dir = self.work_dir = tempfile.mkdtemp(prefix='bitrix24replay')
+        config = ConfigParser()
+        config.read_dict(self.header['config'])
+        config.set('Telegram', 'botid', self.replay_botid)
+        config.set('Bitrix24', 'webhook', self.replay_webhook)
+        config.set('System', 'db', 'sqlite:///bitrix24deals.db')
+        with open(os.path.join(work_dir, 'settings.conf'), 'w') as config_file:
+            config.write(config_file)
+        for name, text in self.header['lists'].items():
+            with open(os.path.join(work_dir, name), 'w') as list_file:
+                list_file.write(text)
+        if os.path.exists(f'{self.path}.db'):
+            shutil.copy(f'{self.path}.db', os.path.join(work_dir, 'bitrix24deals.db'))
+        settings = Conf(base_dir=work_dir)
+        self.secrets = [settings.webhook, settings.botid]
+        return settings
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+capture = None
+
+
+def enable_capture(path, settings=None, replaying=False):
+    """
+    Включает запись (settings — текущие настройки) или воспроизведение.
+    При воспроизведении часы сдвигаются к моменту записи: решения, зависящие от времени
+    (полная сверка, TTL справочников, окна сводок и удаления), те же, что при записи
+    """
+    global capture, time
+    if replaying:
+        capture = Capture(path, replaying=True)
+        offset = capture.header['time'] - time()
+        real_time = time
+        time = lambda: real_time() + offset  # noqa: E731
+        return capture.replay_settings()
+    capture = Capture(path, secrets=[settings.webhook, settings.botid, settings.application_token])
+    capture.write_header(settings)
+    return settings
+
+
+def captured(kind, method, func, *args, **kwargs):
+    """
+    Вызов внешнего API: напрямую или через запись/воспроизведение
+    """
+    if capture is None:
+        return func(*args, **kwargs)
+    return capture.call(kind, method, func, args, kwargs)
+
+
+def profiled(path, func, *args):
+    """
+    Выполняет func под cProfile: профиль сохраняется в path, самое затратное выводится.
+    Профилируется вызывающий поток (отправка в Телеграм в пуле видна как ожидание)
+    """
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+class BitrixClient:
+    """
+    Обёртка над fast_bitrix24: единая точка вызовов REST API для учёта в метриках
+    и записи/воспроизведения
+    """
+
+    def __init__(self, webhook, session=None):
+        self.webhook = webhook
+        self.session = session
+        self.bitrix = None
+
+    @property
+    def connect(self):
+        if self.bitrix is None:
+            from fast_bitrix24 import Bitrix
+            self.bitrix = Bitrix(self.webhook, verbose=False, client=self.session)
+        return self.bitrix
+
+    def get_all(self, method, params=None):
+        started = perf_counter()
+        result = captured('bitrix', 'get_all', self.connect.get_all, method, params=params)
+        metrics.count('rest_calls_total', method=method)
+        metrics.count('rest_pages_total', max(1, -(-len(result) // BITRIX_PAGE_SIZE)), method=method)
+        metrics.count('rest_seconds_total', perf_counter() - started, method=method)
+        return result
+
+    @staticmethod
+    def keyset_params(params, last_id=0):
+        page_params = dict(params, order={'ID': 'ASC'}, start=-1)
+        page_params['filter'] = dict(params.get('filter', {}), **{'>ID': last_id})
+        return page_params
+
+    def list_pages(self, method, params, first_page=None):
+        """
+        Постраничный обход списка по ID (keyset): фильтр '>ID' вместо смещения и start=-1,
+        чтобы портал не считал total. Страницы отдаются по мере получения.
+        first_page — уже полученная первая страница (например, из пакета batch)
+        """
+        last_id = 0
+        page = first_page
+        while True:
+            if page is None:
+                started = perf_counter()
+                page = captured(
+                    'bitrix', 'call', self.connect.call, method, self.keyset_params(params, last_id), raw=True
+                )['result']
+                metrics.count('rest_calls_total', method=method)
+                metrics.count('rest_pages_total', method=method)
+                metrics.count('rest_seconds_total', perf_counter() - started, method=method)
+            if page:
+                yield page
+            if len(page) < BITRIX_PAGE_SIZE:
+                return
+            last_id = int(page[-1]['ID'])
+            page = None
+
+    def batch(self, commands):
+        """
+        Выполняет команды {метка: (метод, параметры)} методом batch, по BITRIX_BATCH_SIZE
+        команд за запрос. Возвращает {метка: (строки, total)}
+        """
+        from fast_bitrix24.utils import http_build_query
+        responses = {}
+        for chunk in peewee.chunked(list(commands.items()), BITRIX_BATCH_SIZE):
+            started = perf_counter()
+            response = captured(
+                'bitrix', 'call', self.connect.call,
+                'batch',
+                {
+                    'halt': 1,
+                    'cmd': {label: f'{method}?{http_build_query(params)}' for label, (method, params) in chunk},
+                },
+                raw=True
+            )['result']
+            metrics.count('rest_calls_total', method='batch')
+            metrics.count('rest_pages_total', len(chunk), method='batch')
+            metrics.count('rest_seconds_total', perf_counter() - started, method='batch')
+            if response.get('result_error'):
+                raise ConnectionError(f'Ошибка batch: {response["result_error"]}')
+            result_total = response.get('result_total') or {}
+            for label, _ in chunk:
+                responses[label] = (response['result'].get(label) or [], result_total.get(label))
+        return responses
+
+    def call(self, method, items):
+        started = perf_counter()
+        result = captured('bitrix', 'call', self.connect.call, method, items)
+        metrics.count('rest_calls_total', method=method)
+        metrics.count('rest_pages_total', max(1, len(items) if isinstance(items, list) else 1), method=method)
+        metrics.count('rest_seconds_total', perf_counter() - started, method=method)
+        return result
+
+
+def connect_db(db_url, sqlite_journal='wal'):
+    """
+    Подключение к БД по URL. Для SQLite: журнал WAL (чтение не ждёт запись),
+    synchronous=NORMAL (fsync только на контрольных точках WAL) и ожидание
+    занятой БД вместо ошибки. Остальные бэкенды peewee — как есть
+    """
+    if not urlparse(db_url).scheme.startswith('sqlite'):
+        return connect(db_url)
+    pragmas = {'journal_mode': sqlite_journal}
+    if sqlite_journal == 'wal':
+        pragmas['synchronous'] = 'normal'
+    return connect(db_url, pragmas=pragmas, timeout=10)
+
+
+def write_transaction(db):
+    """
+    Транзакция записи. В SQLite блокировка на запись берётся сразу (BEGIN IMMEDIATE):
+    транзакция, начатая чтением, при первой записи получает «database is locked»
+    без ожидания, если другой поток (доставка в фоне) успел записать после её чтения
+    """
+    if isinstance(db, peewee.SqliteDatabase):
+        return db.atomic('IMMEDIATE')
+    return db.atomic()
+
+
+class BaseModel(peewee.Model):
+    class Meta:
+        database = db_proxy
+
+
+class Deals(BaseModel):
+    """
+    Скелет БД
+    """
+    id = peewee.IntegerField(primary_key=True)
+    category_id = peewee.IntegerField()
+    assigned_by_id = peewee.IntegerField()
+    date_create = peewee.DateTimeField()
+    title = peewee.TextField()
+    message_id = peewee.IntegerField()
+    message_text = peewee.TextField()
+    digest_id = peewee.IntegerField(null=True)
+    digest_position = peewee.IntegerField(null=True)
+    content_hash = peewee.CharField(null=True)
+    sent_at = peewee.FloatField(null=True)
+
+
+def bind_models(db):
+    """
+    Копии моделей, привязанные к своей БД (db_proxy на процесс один, а в режиме
+    нескольких порталов у каждого портала своя БД)
+    """
+    return {
+        model.__name__: type(model.__name__, (model,), {
+            'Meta': type('Meta', (), {'database': db, 'table_name': model._meta.table_name}),
+        })
+        for model in (Deals, SyncState, Directory, Digest, Sweep, Outbox)
+    }
+
+
+def migrate_db(db, deals, digest):
+    """
+    Приводит схему уже существующей БД к текущей версии моделей
+    """
+    primary_keys = db.get_primary_keys(deals._meta.table_name)
+    indexes = db.get_indexes(deals._meta.table_name)
+    id_unique = any(index.unique and index.columns == ['id'] for index in indexes)
+    if 'id' not in primary_keys and not id_unique:
+        # В старых БД поле id было без первичного ключа
+        with db.atomic():
+            if isinstance(db, peewee.SqliteDatabase):
+                # Из возможных дублей оставляем последние записанные
+                rowid = peewee.SQL('rowid')
+                last_rows = deals.select(peewee.fn.MAX(rowid)).group_by(deals.id)
+                deals.delete().where(rowid.not_in(last_rows)).execute()
+            db.execute(deals.index(deals.id, unique=True, safe=True, name='deals_id_unique'))
+    migrator = SchemaMigrator.from_database(db)
+    operations = []
+    for model, fields in (
+        (deals, (deals.digest_id, deals.digest_position, deals.content_hash, deals.sent_at)),
+        (digest, (digest.sent_at,)),
+    ):
+        columns = {column.name for column in db.get_columns(model._meta.table_name)}
+        operations += [
+            migrator.add_column(model._meta.table_name, field.column_name, field)
+            for field in fields
+            if field.column_name not in columns
+        ]
+    if 'comments' in {column.name for column in db.get_columns(deals._meta.table_name)}:
+        # COMMENTS в сообщение не выводится и больше не запрашивается
+        operations.append(migrator.drop_column(deals._meta.table_name, 'comments'))
+    if operations:
+        migrate(*operations)
+
+
+class SyncState(BaseModel):
+    """
+    Состояние синхронизации: отметка DATE_MODIFY, время полной сверки и т.п.
+    """
+    key = peewee.CharField(primary_key=True)
+    value = peewee.TextField()
+
+
+class Directory(BaseModel):
+    """
+    Кеш справочников Битрикс24: пользователи (user), категории (category), отделы (department)
+    """
+    kind = peewee.CharField()
+    key = peewee.CharField()
+    name = peewee.TextField()
+    department = peewee.CharField(null=True)
+
+    class Meta:
+        primary_key = peewee.CompositeKey('kind', 'key')
+
+
+class Digest(BaseModel):
+    """
+    Сводное сообщение с несколькими новыми сделками чата.
+    parts — JSON-список текстов сделок по позициям (Deals.digest_position)
+    """
+    chat = peewee.CharField()
+    message_id = peewee.IntegerField()
+    parts = peewee.TextField()
+    sent_at = peewee.FloatField(null=True)
+
+
+class Sweep(BaseModel):
+    """
+    Зачёркнутые сообщения, которые нужно удалить до конца 48-часового окна
+    """
+    chat = peewee.CharField()
+    message_id = peewee.IntegerField()
+    delete_at = peewee.FloatField(index=True)
+
+
+class Outbox(BaseModel):
+    """
+    Очередь операций для Телеграма: пишется при поиске изменений, разбирается доставкой.
+    Доставленная операция удаляется в одной транзакции с обновлением Deals
+    """
+    key = peewee.CharField(unique=True)
+    deal_id = peewee.IntegerField()
+    operation = peewee.CharField()
+    chat = peewee.CharField()
+    payload = peewee.TextField()
+    attempts = peewee.IntegerField(default=0)
+    next_attempt = peewee.FloatField(default=0, index=True)
+    created = peewee.FloatField()
+    error = peewee.TextField(null=True)
+
+
+class DealRecord:
+    """
+    Сделка из crm.deal.list в компактном виде: только поля, нужные для сообщений.
+    ID, категория (или отдел) и ответственный — числа, дата создания — datetime
+    """
+    __slots__ = ('id', 'category_id', 'assigned_by_id', 'title', 'date_create')
+
+    def __init__(self, id, category_id, assigned_by_id, title, date_create):
+        self.id = id
+        self.category_id = category_id
+        self.assigned_by_id = assigned_by_id
+        self.title = title
+        self.date_create = date_create
+
+    @classmethod
+    def from_bitrix(cls, deal, category_id=None):
+        return cls(
+            int(deal['ID']),
+            int(deal['CATEGORY_ID'] if category_id is None else category_id),
+            int(deal['ASSIGNED_BY_ID']),
+            deal['TITLE'] or '',
+            datetime.fromisoformat(deal['DATE_CREATE'][:19]),
+        )
+
+    @property
+    def chat(self):
+        return str(self.category_id)
+
+    def to_bitrix(self):
+        """
+        Обратно в вид Битрикс24 — для JSON операции в Outbox
+        """
+        return {
+            'ID': str(self.id),
+            'CATEGORY_ID': self.chat,
+            'ASSIGNED_BY_ID': str(self.assigned_by_id),
+            'TITLE': self.title,
+            'DATE_CREATE': self.date_create.isoformat(),
+        }
+
+    def row(self):
+        """
+        Строка для Deals
+        """
+        return {
+            'id': self.id,
+            'category_id': self.category_id,
+            'assigned_by_id': self.assigned_by_id,
+            'date_create': self.date_create,
+            'title': self.title,
+        }
+
+
+class WriteBatch:
+    """
+    Записи доставки в БД: результаты копятся и применяются одной транзакцией
+    раз в size результатов, раз в interval секунд и в конце прохода. Строки Deals
+    пишутся многострочными запросами (insert_many, bulk_update, delete ... in),
+    удаление выполненных операций из Outbox — в той же транзакции.
+    Если транзакция не прошла, пачка остаётся целиком и повторяется при следующей
+    записи: сообщения уже отправлены, и потерянный результат означал бы повторную отправку
+    """
+
+    def __init__(self, parser, size=100, interval=1):
+        self.parser = parser
+        self.size = size
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.applies = []
+        self.done = []
+        self.started = monotonic()
+        self.reset_rows()
+
+    def reset_rows(self):
+        # Строки собираются заново при каждом применении пачки (apply)
+        self.inserts = []
+        self.updates = {}
+        self.deletes = set()
+        # Сделки, которые в этой пачке уходят из своей сводки
+        self.released = set()
+
+    def add(self, apply, operations):
+        self.applies.append(apply)
+        self.finish(operations)
+        if len(self.applies) >= self.size or monotonic() - self.started >= self.interval:
+            self.flush()
+
+    def finish(self, operations):
+        self.done += [operation.id for operation in operations]
+
+    def insert(self, row):
+        self.inserts.append(row)
+
+    def update(self, deal):
+        self.updates[deal.id] = deal
+        if deal.digest_id is None:
+            self.released.add(deal.id)
+
+    def delete(self, deal_id):
+        self.deletes.add(deal_id)
+        self.released.add(deal_id)
+
+    def flush(self):
+        if not self.applies and not self.done:
+            return
+        deals = self.parser.deals_db
+        outbox = self.parser.outbox
+        self.reset_rows()
+        with write_transaction(self.parser.db):
+            for apply in self.applies:
+                apply()
+            for batch in peewee.chunked(self.inserts, 100):
+                deals.insert_many(batch).execute()
+            if self.updates:
+                deals.bulk_update(list(self.updates.values()), fields=self.parser.deals_message_fields, batch_size=100)
+            for ids_chunk in peewee.chunked(list(self.deletes), 500):
+                deals.delete().where(deals.id.in_(ids_chunk)).execute()
+            for ids_chunk in peewee.chunked(self.done, 500):
+                outbox.delete().where(outbox.id.in_(ids_chunk)).execute()
+        self.reset()
+
+
+class DealsDiff:
+    """
+    Разница между открытыми сделками из Битрикс24 и сделками из БД.
+    Считается за один проход операциями над множествами ID.
+    При инкрементальной синхронизации открытые сделки — только изменённые,
+    поэтому закрытые передаются явно в closed_ids
+    """
+
+    def __init__(self, deals_opened, deals_tracked, closed_ids=None):
+        ids_opened = deals_opened.keys()
+        ids_tracked = deals_tracked.keys()
+        self.new = sorted(ids_opened - ids_tracked)
+        if closed_ids is None:
+            self.closed = sorted(ids_tracked - ids_opened)
+        else:
+            self.closed = sorted(ids_tracked & (closed_ids - ids_opened))
+        self.change_category = []
+        self.change_assigned = []
+        self.change_content = []
+        for deal_id in sorted(ids_opened & ids_tracked):
+            deal = deals_opened[deal_id]
+            deal_db = deals_tracked[deal_id]
+            if deal_db.category_id != deal.category_id:
+                self.change_category.append(deal_id)
+            elif deal_db.assigned_by_id != deal.assigned_by_id:
+                self.change_assigned.append(deal_id)
+            elif deal_db.title != deal.title:
+                self.change_content.append(deal_id)
+
+
+class TokenBucket:
+    """
+    Ведро токенов: пополняется со скоростью rate токенов в секунду, вмещает не более capacity.
+    После ответа 429 блокируется на retry_after и временно снижает скорость
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.nominal_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Забирает токен, если он есть, иначе возвращает время ожидания в секундах
+        """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        while wait > 0:
+            metrics.count('rate_limit_wait_seconds_total', wait)
+            sleep(wait)
+            wait = self.reserve()
+
+    def penalize(self, retry_after):
+        with self.lock:
+            self.blocked_until = monotonic() + retry_after
+            self.tokens = 0
+            self.rate = max(self.rate / 2, self.nominal_rate / 8)
+
+    def reward(self):
+        with self.lock:
+            self.rate = min(self.rate * 1.1, self.nominal_rate)
+
+
+class RateLimiter:
+    """
+    Ограничения Телеграма: не более 20 сообщений в минуту в одну группу
+    и около 30 сообщений в секунду на бота
+    https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+    """
+
+    def __init__(self, chat_rate=20 / 60, chat_burst=1, global_rate=30, max_retries=5):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_buckets = {}
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+
+    def chat_bucket(self, chat_id):
+        with self.lock:
+            if chat_id not in self.chat_buckets:
+                self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return self.chat_buckets[chat_id]
+
+    def call(self, chat_id, func, /, *args, **kwargs):
+        bucket = self.chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            if capture is None or not capture.replaying:
+                # Воспроизведение идёт без пауз
+                bucket.acquire()
+                self.global_bucket.acquire()
+            started = perf_counter()
+            try:
+                result = captured('telegram', func.__name__, func, *args, **kwargs)
+            except ApiTelegramException as exc:
+                metrics.count('telegram_calls_total', method=func.__name__)
+                if exc.error_code != 429 or attempt >= self.max_retries:
+                    raise
+                metrics.count('telegram_429_total')
+                attempt += 1
+                retry_after = exc.result_json.get('parameters', {}).get('retry_after', 1)
+                bucket.penalize(retry_after)
+            else:
+                metrics.count('telegram_calls_total', method=func.__name__)
+                metrics.observe('telegram_latency_seconds', perf_counter() - started)
+                bucket.reward()
+                return result
+
+
+class Dispatcher:
+    """
+    Выполняет задания в пуле потоков: задания одного чата строго по очереди,
+    разных чатов — параллельно. Возвращает пары (результат, исключение) в порядке заданий.
+    Свободный поток берёт чат, у которого в голове очереди самое приоритетное задание,
+    а среди равных — чат, дольше всех ждавший своей очереди (по кругу). Поэтому
+    срочное задание ждёт не больше, чем уже начатые задания своего чата, а чат
+    с длинной очередью не занимает поток, пока другие чаты ждут
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        # Пул живёт между циклами, чтобы потоки переиспользовали свои HTTP-сессии
+        self.pool = None
+
+    def run(self, jobs):
+        results = [(None, None)] * len(jobs)
+        for index, result, error in self.iterate(jobs):
+            results[index] = (result, error)
+        return results
+
+    def iterate(self, jobs):
+        """
+        Отдаёт (индекс, результат, исключение) по мере выполнения заданий.
+        Задание — (чат, вызов) или (чат, вызов, приоритет); меньший приоритет раньше
+        """
+        lanes = {}
+        for index, (chat_key, job, *priority) in enumerate(jobs):
+            lanes.setdefault(chat_key, []).append((priority[0] if priority else 0, index, job))
+        for chat_key, lane in lanes.items():
+            lanes[chat_key] = deque(sorted(lane, key=lambda item: item[:2]))
+        ready = [(lane[0][0], turn, chat_key) for turn, (chat_key, lane) in enumerate(lanes.items())]
+        heapq.heapify(ready)
+        turns = [len(ready)]
+        lock = threading.Lock()
+        done = queue.Queue()
+
+        def run_lanes():
+            # Поток выходит, когда готовых чатов нет: каждый занятый чат доработает свой поток
+            chat_key = None
+            while True:
+                with lock:
+                    if chat_key is not None and lanes[chat_key]:
+                        heapq.heappush(ready, (lanes[chat_key][0][0], turns[0], chat_key))
+                        turns[0] += 1
+                    if not ready:
+                        return
+                    chat_key = heapq.heappop(ready)[2]
+                    _, index, job = lanes[chat_key].popleft()
+                try:
+                    done.put((index, job(), None))
+                except Exception as exc:
+                    done.put((index, None, exc))
+
+        if lanes and self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        for _ in range(min(len(lanes), self.max_workers)):
+            self.pool.submit(run_lanes)
+        for _ in range(len(jobs)):
+            yield done.get()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+class CycleLock:
+    """
+    Блокировка цикла синхронизации: внутри процесса и между процессами (cron, демон),
+    чтобы пересекающиеся запуски не отправляли сделки повторно
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def acquire(self):
+        if not self.lock.acquire(blocking=False):
+            return False
+        self.file = open(self.path, 'w')
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.file.close()
+            self.file = None
+            self.lock.release()
+            return False
+        return True
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+        self.lock.release()
+
+
+class MessageRenderer:
+    """
+    Тексты сообщений о сделках в MarkdownV2. Шаблон собран заранее (эмодзи подставлены
+    один раз), а фрагменты с ответственным берутся из LRU-кеша по ID пользователя и ID
+    в Телеграме: одни и те же ответственные повторяются от сделки к сделке.
+    При обновлении справочника пользователей или telegram_id.list кеш сбрасывается (invalidate)
+    """
+
+    def __init__(self, user, tlgrm_id, emoji=EMOJI, cache_size=RESPONSIBLE_CACHE_SIZE):
+        self.user = user
+        self.tlgrm_id = tlgrm_id
+        self.emoji = emoji
+        self.template = f'{emoji["pin"]}Заявка №*{{deal_id}}*\n{{responsible}}\n\n{emoji["doc"]}{{title}}'
+        self.cached_responsible = lru_cache(maxsize=cache_size)(self.render_responsible)
+
+    def invalidate(self):
+        self.cached_responsible.cache_clear()
+
+    def message(self, deal, new_message=True, old_responsible_id=None):
+        user_name = self.responsible(str(deal.assigned_by_id))
+        if new_message:
+            responsible = f'Ответственный: {user_name}'
+        else:
+            old_user_name = self.responsible(old_responsible_id, new_message)
+            responsible = f'{self.emoji["recycle"]}Смена ответственного: {old_user_name} → {user_name}'
+        # ID сделки — число, экранировать нечего
+        return self.template.format(deal_id=deal.id, responsible=responsible, title=markdownv2_converter(deal.title))
+
+    def responsible(self, user_id, new_message=True):
+        telegram_id = self.tlgrm_id.get(user_id)
+        if self.user(user_id) is None:
+            # Незнакомый пользователь не кешируется: в следующем цикле его снова ищут в Битрикс24
+            return self.render_responsible(user_id, telegram_id, new_message)
+        return self.cached_responsible(user_id, telegram_id, new_message)
+
+    def render_responsible(self, user_id, telegram_id, new_message):
+        user = self.user(user_id)
+        user_name = markdownv2_converter(user['name']) if user else 'Неизвестный'
+        if not new_message:
+            return f'{self.emoji["person"]}__{user_name}__'
+        if telegram_id is None:
+            return f'{self.emoji["person"]}__*{user_name}*__'
+        return f'{self.emoji["person"]}[__*{user_name}*__](tg://user?id={telegram_id})'
+
+
+class Bitrix24Parser:
+
+    def __init__(self, settings, persistent=False):
+        self.settings = settings
+        self.bot_alive = True
+        self.bot = self.generate_bot()
+        self.dispatcher = Dispatcher(self.settings.workers)
+        self.health = HealthCache(self.settings.health_file, self.settings.health_ttl)
+        self.online = self.check_online()
+        self.loop = None
+        self.session = None
+        if persistent:
+            # Своя петля asyncio и aiohttp-сессия, живущие между циклами демона
+            load_asyncio()
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.session = self.loop.run_until_complete(create_bitrix_session())
+        self.connect = BitrixClient(self.settings.webhook, self.session)
+        self.lock = CycleLock(self.settings.lock_file)
+        self.delivery_lock = CycleLock(f'{self.settings.lock_file}.outbox')
+        self.cycles = 0
+        self.directories_loaded = {}
+        self.directories_changed = set()
+        self.users_missing = set()
+        self.users = {}
+        self.categories = {'0': 'Общее'}
+        self.departments = {}
+        self.deals_opened = {}
+        self.deals_closed_ids = None
+        self.deals_tracked = {}
+        self.deals_new = []
+        self.deals_change_assigned = []
+        self.deals_change_category = []
+        self.deals_change_content = []
+        self.deals_closed = []
+        self.date_modify = None
+        self.date_modify_ids = set()
+        self.full_sync = True
+        self.db = connect_db(self.settings.db_url, self.settings.sqlite_journal)
+        if self.settings.portal is None:
+            db_proxy.initialize(self.db)
+            models = {model.__name__: model for model in (Deals, SyncState, Directory, Digest, Sweep, Outbox)}
+        else:
+            models = bind_models(self.db)
+        self.deals_db = models['Deals']
+        self.sync_state = models['SyncState']
+        self.directory = models['Directory']
+        self.outbox = models['Outbox']
+        self.digest = models['Digest']
+        self.sweep = models['Sweep']
+        self.digest_separator = '\n\n'
+        self.writes = WriteBatch(self, self.settings.db_batch, self.settings.db_batch_interval)
+        self.delivery = None
+        self.db.create_tables([self.deals_db, self.sync_state, self.directory, self.outbox, self.digest, self.sweep])
+        migrate_db(self.db, self.deals_db, self.digest)
+        self.deals_message_fields = [
+            self.deals_db.category_id,
+            self.deals_db.assigned_by_id,
+            self.deals_db.title,
+            self.deals_db.message_id,
+            self.deals_db.message_text,
+            self.deals_db.digest_id,
+            self.deals_db.digest_position,
+            self.deals_db.content_hash,
+            self.deals_db.sent_at,
+        ]
+        self.deals_tracked_fields = [
+            self.deals_db.id,
+            self.deals_db.category_id,
+            self.deals_db.assigned_by_id,
+            self.deals_db.title,
+        ]
+        # COMMENTS в сообщение не выводится и не запрашивается
+        self.deals_select = [
+            'ID', 'ASSIGNED_BY_ID', 'TITLE', 'DATE_CREATE', 'CATEGORY_ID', 'DATE_MODIFY', 'CLOSED',
+        ]
+        self.deals_first_page = None
+        self.directory_requests = {
+            'user': ('user.get', {
+                'select': ['ID', 'NAME', 'LAST_NAME', 'UF_DEPARTMENT'],
+                # 'filter': {'ACTIVE': 'True'}
+            }),
+            'category': ('crm.dealcategory.list', {
+                'select': ['ID', 'NAME'],
+                'filter': {'IS_LOCKED': 'N'}
+            }),
+            'department': ('department.get', {
+                'select': ['ID', 'NAME'],
+            }),
+        }
+        self.emoji = EMOJI
+        self.renderer = MessageRenderer(self.user, self.settings.tlgrm_id, self.emoji)
+
+    def check_online(self):
+        return self.health.probe(
+            f'bitrix {urlparse(self.settings.webhook).netloc}',
+            partial(captured, 'bitrix', 'check_online', check_online, self.settings.webhook),
+        )
+
+    def generate_bot(self):
+        bots = {}
+        self.tlgrm = tlgrm_client(self.settings)
+        for chat_id in self.settings.chat_id.keys():
+            bots[chat_id] = TlgrmBot(
+                client=self.tlgrm,
+                chatid=self.settings.chat_id[chat_id],
+            )
+        if not self.tlgrm.alive():
+            self.bot_alive = False
+        return bots
+
+    def run_cycle(self, deal_ids=None):
+        """
+        Цикл синхронизации под блокировкой: полный/инкрементальный или,
+        если переданы deal_ids, только по этим сделкам (режим push).
+        Возвращает False, если цикл не запускался
+        """
+        if not self.lock.acquire():
+            print('Предыдущий цикл ещё не завершён, пропускаем запуск')
+            return False
+        try:
+            if self.loop is not None:
+                # Цикл может выполняться в любом потоке пула, а сессия Битрикс24 живёт в своей петле
+                asyncio.set_event_loop(self.loop)
+            if self.cycles:
+                self.online = self.check_online()
+            if not self.online:
+                return False
+            if deal_ids is None:
+                self.run()
+            else:
+                self.run_deals(deal_ids)
+        finally:
+            self.cycles += 1
+            self.lock.release()
+        return True
+
+    def run(self):
+        metrics.start_cycle(self.settings.portal)
+        self.reset_cycle()
+        self.cycle_started = time()
+        self.full_sync = self.full_sync_required()
+        self.refresh_directories(self.deals_params())
+        with metrics.phase('generate_opened_deals'):
+            self.generate_opened_deals()
+        self.deliver()
+        with metrics.phase('save_sync_state'):
+            self.save_sync_state()
+        metrics.finish_cycle()
+
+    def run_deals(self, deal_ids):
+        """
+        Обработка только указанных сделок: из БД и из Битрикс24 берутся лишь они,
+        всё, что среди них не открыто, считается закрытым
+        """
+        metrics.start_cycle(self.settings.portal)
+        self.reset_cycle()
+        deals_params = {
+            'select': self.deals_select,
+            'filter': {'@ID': sorted(deal_ids)}
+        }
+        self.refresh_directories(deals_params)
+        with metrics.phase('generate_opened_deals'):
+            pages = self.connect.list_pages('crm.deal.list', deals_params, self.deals_first_page)
+            for page in pages:
+                for deal in page:
+                    self.add_opened_deal(deal)
+            self.deals_tracked = self.tracked_deals_by_ids(deal_ids)
+            self.deals_closed_ids = set(deal_ids)
+            self.apply_changes()
+        self.deliver()
+        metrics.finish_cycle()
+
+    def refresh_directories(self, deals_params=None):
+        """
+        Справочник берётся из памяти, из кеша в БД или, если кеш старше ttl, из Битрикс24.
+        Устаревшие справочники запрашиваются не по очереди, а вместе: первые страницы
+        всех справочников и первая страница сделок (deals_params) уходят одним запросом
+        batch, остальные страницы справочников по известному total — следующим
+        """
+        self.directories_changed = set()
+        self.deals_first_page = None
+        directories = {
+            'user': (self.settings.users_ttl, self.generate_users),
+            'category': (self.settings.categories_ttl, self.generate_categories),
+            'department': (self.settings.departments_ttl, self.generate_departments),
+        }
+        now = time()
+        kinds_fetch = []
+        for kind, (ttl, generate) in directories.items():
+            if now - self.directories_loaded.get(kind, 0) < ttl:
+                continue
+            updated = float(self.read_sync_state(f'{kind}_updated', 0))
+            if kind not in self.directories_loaded and now - updated < ttl:
+                self.load_directory(kind)
+                self.directories_loaded[kind] = updated
+            else:
+                kinds_fetch.append(kind)
+        if not kinds_fetch:
+            return
+        with metrics.phase('fetch_directories'):
+            rows = self.fetch_directories(kinds_fetch, deals_params)
+        for kind in kinds_fetch:
+            generate = directories[kind][1]
+            with metrics.phase(generate.__name__):
+                generate(rows[kind])
+            if self.store_directory(kind):
+                self.directories_changed.add(kind)
+            self.directories_loaded[kind] = now
+        if 'user' in self.directories_changed:
+            # Перезапрошенный, но не изменившийся справочник кеш фрагментов не сбрасывает
+            self.renderer.invalidate()
+
+    def fetch_directories(self, kinds, deals_params=None):
+        commands = {}
+        for kind in kinds:
+            method, params = self.directory_requests[kind]
+            commands[kind] = (method, dict(params, start=0))
+        if deals_params is not None:
+            commands['deals'] = ('crm.deal.list', self.connect.keyset_params(deals_params))
+        responses = self.connect.batch(commands)
+        if deals_params is not None:
+            self.deals_first_page = responses.pop('deals')[0]
+        rows = {kind: list(result) for kind, (result, _) in responses.items()}
+        commands_rest = {}
+        for kind, (result, total) in responses.items():
+            method, params = self.directory_requests[kind]
+            for start in range(len(result), total or 0, BITRIX_PAGE_SIZE):
+                commands_rest[f'{kind}_{start}'] = (method, dict(params, start=start))
+        for label, (result, _) in self.connect.batch(commands_rest).items():
+            rows[label.rsplit('_', 1)[0]] += result
+        return rows
+
+    def directory_rows(self, kind):
+        if kind == 'user':
+            return {key: (user['name'], user['department']) for key, user in self.users.items()}
+        if kind == 'category':
+            return {key: (name, None) for key, name in self.categories.items()}
+        return {key: (name, None) for key, name in self.departments.items()}
+
+    def load_directory(self, kind):
+        rows = self.directory.select().where(self.directory.kind == kind)
+        if kind == 'user':
+            self.users = {row.key: {'name': row.name, 'department': row.department} for row in rows}
+            self.renderer.invalidate()
+        elif kind == 'category':
+            self.categories.update({row.key: row.name for row in rows})
+        else:
+            self.departments = {row.key: row.name for row in rows}
+
+    def store_directory(self, kind):
+        """
+        Записывает в кеш только изменившиеся записи. Возвращает True, если что-то изменилось
+        """
+        rows_cached = {
+            row.key: (row.name, row.department)
+            for row in self.directory.select().where(self.directory.kind == kind)
+        }
+        rows = self.directory_rows(kind)
+        changed = [
+            {'kind': kind, 'key': key, 'name': name, 'department': department}
+            for key, (name, department) in rows.items()
+            if rows_cached.get(key) != (name, department)
+        ]
+        removed = rows_cached.keys() - rows.keys()
+        with write_transaction(self.db):
+            for batch in peewee.chunked(changed, 100):
+                self.directory.replace_many(batch).execute()
+            if removed:
+                self.directory.delete().where(
+                    (self.directory.kind == kind) & (self.directory.key.in_(list(removed)))
+                ).execute()
+            self.write_sync_state(f'{kind}_updated', time())
+        return bool(changed or removed)
+
+    def user(self, user_id):
+        """
+        Пользователь из кеша. Незнакомый пользователь подтягивается из Битрикс24 по одному
+        """
+        if user_id not in self.users and user_id not in self.users_missing:
+            bitrix24_users = self.connect.get_all(
+                'user.get',
+                params={'filter': {'ID': user_id}}
+            )
+            for user in bitrix24_users:
+                self.users[user['ID']] = {
+                    'name': f'{user["NAME"]} {user["LAST_NAME"]}',
+                    'department': str(user["UF_DEPARTMENT"][0]),
+                }
+                user_cached = self.users[user['ID']]
+                self.directory.replace(
+                    kind='user', key=user['ID'], name=user_cached['name'], department=user_cached['department'],
+                ).execute()
+            if user_id not in self.users:
+                self.users_missing.add(user_id)
+        return self.users.get(user_id)
+
+    def apply_changes(self):
+        """
+        Сверяет текущую порцию открытых сделок с отслеживаемыми и ставит изменения в очередь
+        """
+        with metrics.phase('check_new_deals'):
+            self.check_new_deals()
+        with metrics.phase('enqueue_changes'):
+            self.enqueue_changes()
+
+    def deliver(self):
+        if self.delivery is None:
+            with metrics.phase('deliver_outbox'):
+                # Отложенные операции — следующими проходами; у сделки в очереди
+                # не больше одной операции каждого типа
+                for _ in range(len(self.settings.priority)):
+                    if not self.deliver_outbox():
+                        break
+
+    def reset_cycle(self):
+        if self.settings.reload_tlgrm_id():
+            # Поправили telegram_id.list: упоминания в кеше устарели
+            self.renderer.invalidate()
+        self.date_modify = None
+        self.date_modify_ids = set()
+        self.users_missing = set()
+        self.deals_opened = {}
+        self.deals_closed_ids = None
+        self.deals_tracked = {}
+        self.deals_new = []
+        self.deals_change_assigned = []
+        self.deals_change_category = []
+        self.deals_closed = []
+
+    def start_delivery(self):
+        """
+        Фоновая доставка очереди: в режиме демона отправка не ждёт опроса Битрикс24
+        """
+        self.delivery = DeliveryWorker(self)
+        self.delivery.start()
+
+    def close(self):
+        if self.delivery is not None:
+            self.delivery.stop()
+        self.dispatcher.close()
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+            self.loop.close()
+        self.db.close()
+
+    def read_sync_state(self, key, default=None):
+        try:
+            return self.sync_state.get_by_id(key).value
+        except self.sync_state.DoesNotExist:
+            return default
+
+    def write_sync_state(self, key, value):
+        self.sync_state.replace(key=key, value=str(value)).execute()
+
+    def full_sync_required(self):
+        """
+        Полная сверка нужна в режиме full, при первом запуске
+        и раз в full_sync_interval секунд в режиме incremental
+        """
+        if self.settings.sync_mode != 'incremental':
+            return True
+        if self.read_sync_state('date_modify') is None:
+            return True
+        last_full_sync = float(self.read_sync_state('last_full_sync', 0))
+        return time() - last_full_sync >= self.settings.full_sync_interval
+
+    def save_sync_state(self):
+        """
+        Отметки сохраняются только после успешно отработанного цикла
+        """
+        with write_transaction(self.db):
+            if self.date_modify:
+                self.write_sync_state('date_modify', self.date_modify.isoformat())
+                self.write_sync_state('date_modify_ids', ','.join(sorted(self.date_modify_ids)))
+            if self.full_sync:
+                self.write_sync_state('last_full_sync', self.cycle_started)
+
+    def tracked_deals(self):
+        """
+        Отслеживаемые сделки в порядке ID: читаются порциями по первичному ключу,
+        в памяти — только нужные для сверки поля одной порции
+        """
+        last_id = 0
+        while True:
+            rows = list(
+                self.deals_db.select(*self.deals_tracked_fields)
+                .where(self.deals_db.id > last_id)
+                .order_by(self.deals_db.id)
+                .limit(1000)
+                .namedtuples()
+            )
+            yield from rows
+            if len(rows) < 1000:
+                return
+            last_id = rows[-1].id
+
+    def tracked_deals_by_ids(self, deal_ids):
+        tracked = {}
+        for ids_chunk in peewee.chunked(list(deal_ids), 500):
+            rows = self.deals_db.select(*self.deals_tracked_fields).where(self.deals_db.id.in_(ids_chunk))
+            tracked.update({row.id: row for row in rows.namedtuples()})
+        return tracked
+
+    def check_new_deals(self):
+        diff = DealsDiff(self.deals_opened, self.deals_tracked, self.deals_closed_ids)
+        self.deals_new = [self.deals_opened[deal_id] for deal_id in diff.new]
+        self.deals_change_category = [self.deals_opened[deal_id] for deal_id in diff.change_category]
+        self.deals_change_assigned = [self.deals_opened[deal_id] for deal_id in diff.change_assigned]
+        self.deals_change_content = [self.deals_opened[deal_id] for deal_id in diff.change_content]
+        self.deals_closed = [self.deals_tracked[deal_id] for deal_id in diff.closed]
+
+    def enqueue_changes(self):
+        """
+        Все найденные изменения одной транзакцией записываются в очередь Outbox.
+        Ключ операции — ID сделки и тип операции: повторно найденное изменение
+        обновляет ещё не доставленную операцию, а не дублирует её
+        """
+        if self.deals_closed_ids:
+            # Сделка закрылась, пока её оповещение ждало в очереди (например, окна сводки)
+            self.drop_pending_new(self.deals_closed_ids - self.deals_opened.keys())
+        operations = []
+        for deal in self.deals_closed:
+            operations.append(('closed', deal.id, str(deal.category_id), {}))
+        for deal in self.deals_change_category:
+            deal_in_db = self.deals_tracked[deal.id]
+            chat = deal.chat if deal.chat in self.bot else str(deal_in_db.category_id)
+            operations.append(('category', deal.id, chat, self.payload(deal)))
+        for deal in self.deals_change_assigned:
+            deal_in_db = self.deals_tracked[deal.id]
+            message_text = self.generate_message(
+                deal=deal,
+                new_message=False,
+                old_responsible_id=str(deal_in_db.assigned_by_id)
+            )
+            operations.append(('assigned', deal.id, deal.chat, self.payload(deal, message_text)))
+        for deal in self.deals_change_content:
+            deal_in_db = self.deals_tracked[deal.id]
+            operations.append(('content', deal.id, str(deal_in_db.category_id), self.payload(deal)))
+        for deal in self.deals_new:
+            if deal.chat not in self.bot:
+                continue
+            operations.append(('new', deal.id, deal.chat, self.payload(deal)))
+        if not operations:
+            return
+        now = time()
+        rows = {
+            f'{deal_id}:{operation}': {
+                'key': f'{deal_id}:{operation}',
+                'deal_id': deal_id,
+                'operation': operation,
+                'chat': chat,
+                'payload': json.dumps(payload, ensure_ascii=False),
+                'created': now,
+                # Новые сделки копятся в окне сводки, чтобы уйти одним сообщением
+                'next_attempt': now + self.settings.digest_window if operation == 'new' else 0,
+            }
+            for operation, deal_id, chat, payload in operations
+        }
+        with write_transaction(self.db):
+            rows_exist = {}
+            for keys_chunk in peewee.chunked(list(rows), 500):
+                rows_exist.update({row.key: row for row in self.outbox.select().where(self.outbox.key.in_(keys_chunk))})
+            for key, row_exist in rows_exist.items():
+                row = rows.pop(key)
+                if (row_exist.chat, row_exist.payload) != (row['chat'], row['payload']):
+                    self.outbox.update(chat=row['chat'], payload=row['payload']).where(
+                        self.outbox.key == key
+                    ).execute()
+            for batch in peewee.chunked(list(rows.values()), 100):
+                self.outbox.insert_many(batch).execute()
+        if self.delivery is not None:
+            self.delivery.wake.set()
+
+    def drop_pending_new(self, deal_ids):
+        """
+        Неотправленные новые сделки, которые уже не открыты, не нужны
+        """
+        for ids_chunk in peewee.chunked(list(deal_ids), 500):
+            self.outbox.delete().where(
+                (self.outbox.operation == 'new') & (self.outbox.deal_id.in_(ids_chunk))
+            ).execute()
+
+    def payload(self, deal, text=None):
+        """
+        Операция для очереди: сделка, готовый текст сообщения и хеш содержимого
+        """
+        if text is None:
+            text = self.generate_message(deal)
+        return {'deal': deal.to_bitrix(), 'text': text, 'hash': content_hash(deal, text)}
+
+    def deliver_outbox(self):
+        """
+        Доставка операций из очереди. Каждая операция сверяется с текущим состоянием
+        Deals (уже доставленное повторно не отправляется), результаты записываются
+        пачками (WriteBatch) по мере готовности. Ошибка откладывает операцию
+        с экспоненциально растущей паузой, не задерживая остальные чаты.
+        За проход у сделки не больше одного задания, поэтому операции одной сделки
+        (даже в разных чатах) не обгоняют друг друга. Возвращает количество операций,
+        отложенных до следующего прохода
+        """
+        if not self.delivery_lock.acquire():
+            return 0
+        try:
+            # Сначала — результаты прошлого прохода, не записанные из-за ошибки БД:
+            # пока их операции в очереди, отправлять нельзя
+            self.writes.flush()
+            now = time()
+            operations = list(
+                self.outbox.select()
+                .where(self.outbox.next_attempt <= now)
+                .order_by(self.outbox.id)
+            )
+            chats_new = {operation.chat for operation in operations if operation.operation == 'new'}
+            if self.settings.digest_window and chats_new:
+                # В сводку попадают и новые сделки этих чатов, чьё окно ещё не истекло
+                operations += list(
+                    self.outbox.select()
+                    .where(
+                        (self.outbox.next_attempt > now)
+                        & (self.outbox.operation == 'new')
+                        & (self.outbox.attempts == 0)
+                        & (self.outbox.chat.in_(list(chats_new)))
+                    )
+                    .order_by(self.outbox.id)
+                )
+            deals_in_db = {}
+            for ids_chunk in peewee.chunked(list({operation.deal_id for operation in operations}), 500):
+                deals_in_db.update({
+                    deal.id: deal for deal in self.deals_db.select().where(self.deals_db.id.in_(ids_chunk))
+                })
+            digests = {}
+            jobs = []
+            prepared = []
+            pending_new = {}
+            pending_delete = {}
+            digest_edits = {}
+            deals_digest_edit = set()
+            deals_scheduled = set()
+            deferred = 0
+            priority = self.settings.priority
+            for operation in operations:
+                deal_in_db = deals_in_db.get(operation.deal_id)
+                digest_edit = (
+                    operation.operation in ('content', 'closed')
+                    and deal_in_db is not None
+                    and deal_in_db.digest_id is not None
+                )
+                if operation.deal_id in deals_scheduled and not (digest_edit and operation.deal_id in deals_digest_edit):
+                    # У сделки уже есть задание в этом проходе (возможно, в другом чате):
+                    # следующая операция — в следующем проходе, по записанному результату
+                    deferred += 1
+                    continue
+                payload = json.loads(operation.payload)
+                try:
+                    job = self.prepare_delivery(operation, payload, deal_in_db, digests)
+                except Exception as exc:
+                    self.postpone_delivery(operation, exc)
+                    continue
+                if job is None:
+                    # Операция устарела или уже выполнена
+                    self.writes.finish([operation])
+                    continue
+                deals_scheduled.add(operation.deal_id)
+                if operation.operation == 'new':
+                    pending_new.setdefault(operation.chat, []).append((operation, payload, job))
+                    continue
+                if operation.operation == 'closed' and self.close_by_delete(deal_in_db):
+                    pending_delete.setdefault(operation.chat, []).append(operation)
+                    continue
+                rank = priority.get(operation.operation, len(priority))
+                if digest_edit:
+                    digest_edits.setdefault(deal_in_db.digest_id, []).append((operation, rank))
+                    deals_digest_edit.add(operation.deal_id)
+                    continue
+                prepared.append(('single', [operation]))
+                jobs.append((operation.chat, job, rank))
+            for digest_id, group in digest_edits.items():
+                # Все части сводки уже помечены (mark_digest_part): одна правка сообщения на сводку
+                digest = digests[digest_id]
+                prepared.append(('digest_edit', [operation for operation, rank in group]))
+                jobs.append((digest['chat'], partial(self.edit_digest, digest), max(rank for operation, rank in group)))
+            for chat, pending in pending_new.items():
+                for pack in self.pack_digests(pending):
+                    if len(pack) == 1:
+                        operation, payload, job = pack[0]
+                        prepared.append(('single', [operation]))
+                        jobs.append((chat, partial(self.send_new, [operation], job), priority['new']))
+                        continue
+                    text = self.digest_separator.join(payload['text'] for operation, payload, job in pack)
+                    operations_pack = [operation for operation, payload, job in pack]
+                    prepared.append(('digest', operations_pack))
+                    job = partial(self.bot[chat].send_text_message, text)
+                    jobs.append((chat, partial(self.send_new, operations_pack, job), priority['new']))
+            for chat, pending in pending_delete.items():
+                # Закрытые сделки со свежими сообщениями удаляются пачками
+                for pack in peewee.chunked(pending, TLGRM_DELETE_BATCH):
+                    message_ids = [deals_in_db[operation.deal_id].message_id for operation in pack]
+                    prepared.append(('delete', pack))
+                    jobs.append((chat, partial(self.bot[chat].delete_messages, message_ids), priority['closed']))
+            for index, result, error in self.dispatcher.iterate(jobs):
+                kind, pack = prepared[index]
+                try:
+                    if error:
+                        for operation in pack:
+                            self.postpone_delivery(operation, error)
+                    else:
+                        self.writes.add(partial(self.apply_result, kind, pack, deals_in_db, result), pack)
+                except Exception as exc:
+                    # Результат остаётся в пачке. Задания дорабатываются до конца:
+                    # брошенный iterate отправил бы остальное без записи результатов
+                    print(f'Не удалось записать результаты доставки: {exc}')
+            self.writes.flush()
+            self.sweep_messages()
+            return deferred
+        finally:
+            try:
+                self.writes.flush()
+            finally:
+                self.delivery_lock.release()
+
+    def send_new(self, operations, job):
+        """
+        Отправка новых сделок. Ожидание каждой (new_deal_queue_seconds) считается
+        от записи в Outbox до начала отправки, за вычетом окна сводки digest_window:
+        сюда входят прошлые проходы, повторные попытки и очередь чата, но не сам вызов
+        """
+        started = time()
+        for operation in operations:
+            waited = max(0, started - operation.created - self.settings.digest_window)
+            metrics.observe('new_deal_queue_seconds', waited)
+            metrics.peak('new_deal_queue_seconds', waited)
+        return job()
+
+    def deletable(self, sent_at):
+        """
+        Можно ли ещё удалить сообщение: известно время отправки и 48 часов не прошли
+        """
+        return sent_at is not None and time() - sent_at < TLGRM_DELETE_WINDOW - TLGRM_DELETE_MARGIN
+
+    def close_by_delete(self, deal_in_db):
+        return (
+            self.settings.closed_action == 'delete'
+            and deal_in_db.digest_id is None
+            and self.deletable(deal_in_db.sent_at)
+        )
 
+    def schedule_sweep(self, chat, message_id, sent_at):
+        """
+        Ставит зачёркнутое сообщение в очередь на удаление незадолго до конца 48-часового окна
+        """
+        if not self.settings.sweep or not self.deletable(sent_at):
+            return
+        delete_at = sent_at + TLGRM_DELETE_WINDOW - TLGRM_DELETE_MARGIN
+        self.sweep.insert(chat=chat, message_id=message_id, delete_at=delete_at).execute()
 
-class Deals(BaseModel):
-    """
-    Скелет БД
-    """
-    id = peewee.IntegerField()
-    category_id = peewee.IntegerField()
-    assigned_by_id = peewee.IntegerField()
-    date_create = peewee.DateTimeField()
-    title = peewee.TextField()
-    comments = peewee.TextField()
-    message_id = peewee.IntegerField()
-    message_text = peewee.TextField()
+    def sweep_messages(self):
+        """
+        Удаляет пачками зачёркнутые сообщения, у которых подходит к концу окно удаления.
+        Опоздавшие (окно уже закрыто) просто забываются
+        """
+        now = time()
+        rows = list(self.sweep.select().where(self.sweep.delete_at <= now))
+        if not rows:
+            return
+        expired = [row.id for row in rows if row.delete_at + TLGRM_DELETE_MARGIN <= now or row.chat not in self.bot]
+        pending = {}
+        for row in rows:
+            if row.id not in expired:
+                pending.setdefault(row.chat, []).append(row)
+        jobs = []
+        packs = []
+        for chat, chat_rows in pending.items():
+            for pack in peewee.chunked(chat_rows, TLGRM_DELETE_BATCH):
+                packs.append(pack)
+                jobs.append((chat, partial(self.bot[chat].delete_messages, [row.message_id for row in pack])))
+        for index, result, error in self.dispatcher.iterate(jobs):
+            if error:
+                print(f'Не удалось удалить устаревшие сообщения: {error}')
+                continue
+            expired += [row.id for row in packs[index]]
+        for ids_chunk in peewee.chunked(expired, 500):
+            self.sweep.delete().where(self.sweep.id.in_(ids_chunk)).execute()
 
+    def prepare_delivery(self, operation, payload, deal_in_db, digests):
+        """
+        Вызов Телеграма для операции или None, если операция уже неактуальна.
+        Сделка из сводки не удаляется из чата: её часть в сводке помечается и
+        сводка переписывается целиком (digests — состояние сводок на этот проход)
+        """
+        if operation.operation == 'new':
+            category_id = payload['deal']['CATEGORY_ID']
+            if deal_in_db is not None or category_id not in self.bot:
+                return None
+            return partial(self.bot[category_id].send_text_message, payload['text'])
+        if deal_in_db is None:
+            return None
+        if deal_in_db.content_hash is not None and deal_in_db.content_hash == payload.get('hash'):
+            # В Телеграме уже именно это содержимое
+            return None
+        if operation.operation == 'content':
+            if deal_in_db.category_id != int(payload['deal']['CATEGORY_ID']) or operation.chat not in self.bot:
+                return None
+            if deal_in_db.digest_id is not None:
+                return partial(self.edit_digest, self.mark_digest_part(digests, deal_in_db, payload['text']))
+            return partial(self.bot[operation.chat].edit_exist_message, deal_in_db.message_id, payload['text'])
+        if operation.operation == 'closed':
+            if deal_in_db.digest_id is not None:
+                digest = self.mark_digest_part(digests, deal_in_db, self.closed_text(deal_in_db.message_text))
+                return partial(self.edit_digest, digest)
+            new_message_text = self.closed_text(deal_in_db.message_text)
+            return partial(self.bot[operation.chat].edit_exist_message, deal_in_db.message_id, new_message_text)
+        deal = payload['deal']
+        if operation.operation == 'assigned':
+            if deal_in_db.assigned_by_id == int(deal['ASSIGNED_BY_ID']):
+                return None
+            category_id_old = category_id = deal['CATEGORY_ID']
+        else:
+            if deal_in_db.category_id == int(deal['CATEGORY_ID']):
+                return None
+            category_id = deal['CATEGORY_ID']
+            category_id_old = str(deal_in_db.category_id)
+        if deal_in_db.digest_id is not None:
+            digest = self.mark_digest_part(digests, deal_in_db, self.deprecated_text(deal_in_db.message_text))
+            deprecate = partial(self.edit_digest, digest)
+        else:
+            deprecate = partial(
+                self.check_deprecated_message,
+                category_id_old, deal_in_db.message_id, deal_in_db.message_text, deal_in_db.sent_at,
+            )
+        return partial(self.send_and_deprecate, category_id, payload['text'], deprecate)
 
-class Bitrix24Parser:
+    def apply_delivery(self, operation, payload, deal_in_db, message_id):
+        if operation.operation == 'content':
+            if deal_in_db.digest_id is not None:
+                self.store_digest_part(deal_in_db, payload['text'], released=False)
+            self.store_message(deal_in_db, payload, message_id, deal_in_db.digest_position)
+        elif operation.operation == 'new':
+            deal_lower = DealRecord.from_bitrix(payload['deal']).row()
+            deal_lower['message_id'] = message_id
+            deal_lower['message_text'] = payload['text']
+            deal_lower['content_hash'] = payload.get('hash')
+            deal_lower['sent_at'] = time()
+            deal_lower['digest_id'] = deal_lower['digest_position'] = None
+            self.writes.insert(deal_lower)
+        elif operation.operation == 'closed':
+            if message_id:
+                if deal_in_db.digest_id is not None:
+                    self.store_digest_part(deal_in_db, self.closed_text(deal_in_db.message_text))
+                else:
+                    self.schedule_sweep(operation.chat, deal_in_db.message_id, deal_in_db.sent_at)
+                self.writes.delete(deal_in_db.id)
+        elif operation.operation == 'assigned':
+            if message_id:
+                if deal_in_db.digest_id is not None:
+                    self.store_digest_part(deal_in_db, self.deprecated_text(deal_in_db.message_text))
+                deal_in_db.assigned_by_id = int(payload['deal']['ASSIGNED_BY_ID'])
+                self.store_message(deal_in_db, payload, message_id)
+        else:
+            if deal_in_db.digest_id is not None:
+                self.store_digest_part(deal_in_db, self.deprecated_text(deal_in_db.message_text))
+            if message_id is None:
+                self.writes.delete(deal_in_db.id)
+                return
+            deal_in_db.category_id = payload['deal']['CATEGORY_ID']
+            deal_in_db.assigned_by_id = payload['deal']['ASSIGNED_BY_ID']
+            self.store_message(deal_in_db, payload, message_id)
 
-    def __init__(self, settings):
-        self.settings = settings
-        self.bot_alive = True
-        self.bot = self.generate_bot()
-        self.online = check_online(self.settings.webhook)
-        self.connect = Bitrix(self.settings.webhook, verbose=False)
-        self.users = {}
-        self.categories = {'0': 'Общее'}
-        self.departments = {}
-        self.deals_opened = []
-        self.deals_new = []
-        self.deals_change_assigned = []
-        self.deals_change_category = []
-        self.deals_db = Deals
-        self.db = connect(self.settings.db_url)
-        db_proxy.initialize(self.db)
-        self.db.create_tables([self.deals_db])
-        self.emoji = {
-            'person': '\U0001F9D1',     # 🧑
-            'pin': '\U0001F4CC',        # 📌
-            'doc': '\U0001F4CB',        # 📋
-            'recycle': '\U0000267B',    # ♻
-            'category': '\U0001F4CE',   # 📎
-            'check': '\U00002705',      # ✅
-            'warning': '\U000026A0',    # ⚠️
-        }
+    def store_message(self, deal_in_db, payload, message_id, digest_position=None):
+        """
+        Записывает в Deals новое сообщение сделки вместе с названием и хешем
+        """
+        deal_in_db.title = payload['deal']['TITLE']
+        if message_id != deal_in_db.message_id:
+            deal_in_db.sent_at = time()
+        deal_in_db.message_id = message_id
+        deal_in_db.message_text = payload['text']
+        deal_in_db.content_hash = payload.get('hash')
+        if digest_position is None:
+            deal_in_db.digest_id = None
+        deal_in_db.digest_position = digest_position
+        self.writes.update(deal_in_db)
 
-    def generate_bot(self):
-        bots = {}
-        for chat_id in self.settings.chat_id.keys():
-            bots[chat_id] = TlgrmBot(
-                botid=self.settings.botid,
-                chatid=self.settings.chat_id[chat_id],
-            )
-            if not bots[chat_id].alive():
-                self.bot_alive = False
-        return bots
+    def apply_result(self, kind, pack, deals_in_db, message_id):
+        """
+        Записывает результат задания доставки. Если транзакция пачки не прошла, запись
+        повторяется, поэтому сделки из БД меняются на копиях, а не в deals_in_db
+        """
+        if kind == 'digest':
+            self.apply_digest(pack, message_id)
+            return
+        if kind == 'delete':
+            self.apply_bulk_delete(pack)
+            return
+        deals = {}
+        for operation in pack:
+            deal_in_db = deals_in_db.get(operation.deal_id)
+            if deal_in_db is not None and operation.deal_id not in deals:
+                deals[operation.deal_id] = self.deals_db(**deal_in_db.__data__)
+        for operation in pack:
+            self.apply_delivery(operation, json.loads(operation.payload), deals.get(operation.deal_id), message_id)
 
-    def run(self):
-        self.generate_users()
-        self.generate_categories()
-        self.generate_departments()
-        self.generate_opened_deals()
-        self.remove_closed_deals()
-        self.check_new_deals()
-        if self.deals_change_category:
-            self.update_db_and_change_category()
-        if self.deals_change_assigned:
-            self.update_db_and_change_assigned()
-        if self.deals_new:
-            self.update_db_and_send_new_deals()
+    def apply_bulk_delete(self, pack):
+        for operation in pack:
+            self.writes.delete(operation.deal_id)
 
-    def check_new_deals(self):
-        deals_new = []
-        deals_change_category = []
-        deals_change_assigned = []
-        for deal in self.deals_opened:
-            if not self.deal_in_db(deal['ID']):
-                deals_new.append(deal)
-            elif self.deal_in_db(deal['ID']):
-                category_changed, assigned_changed = self.data_changed(
-                    deal['ID'],
-                    deal['CATEGORY_ID'],
-                    deal['ASSIGNED_BY_ID'],
-                )
-                if category_changed:
-                    deals_change_category.append(deal)
-                if assigned_changed and not category_changed:
-                    deals_change_assigned.append(deal)
-        self.deals_new = sorted(deals_new, key=lambda x: int(x['ID']))
-        self.deals_change_category = sorted(deals_change_category, key=lambda x: int(x['ID']))
-        self.deals_change_assigned = sorted(deals_change_assigned, key=lambda x: int(x['ID']))
-
-    def data_changed(self, deal_id, category_id, assigned_id):
-        deal = self.deals_db.get(
-            self.deals_db.id == int(deal_id),
+    def apply_digest(self, pack, message_id):
+        """
+        Запоминает отправленную сводку и позицию каждой сделки в ней
+        """
+        payloads = [json.loads(operation.payload) for operation in pack]
+        parts = [payload['text'] for payload in payloads]
+        sent_at = time()
+        digest = self.digest.create(
+            chat=pack[0].chat, message_id=message_id, parts=json.dumps(parts, ensure_ascii=False), sent_at=sent_at,
         )
-        category_changed = (deal.category_id != int(category_id))
-        assigned_changed = (deal.assigned_by_id != int(assigned_id))
-        return category_changed, assigned_changed
+        for position, payload in enumerate(payloads):
+            deal_lower = DealRecord.from_bitrix(payload['deal']).row()
+            deal_lower['message_id'] = message_id
+            deal_lower['message_text'] = payload['text']
+            deal_lower['digest_id'] = digest.id
+            deal_lower['digest_position'] = position
+            deal_lower['content_hash'] = payload.get('hash')
+            deal_lower['sent_at'] = sent_at
+            self.writes.insert(deal_lower)
 
-    def deal_in_db(self, deal_id):
-        try:
-            self.deals_db.get(
-                self.deals_db.id == int(deal_id),
-            )
-        except self.deals_db.DoesNotExist:
-            return False
+    def pack_digests(self, pending):
+        """
+        Раскладывает новые сделки чата по сообщениям. Сводка собирается, если сделок
+        не меньше digest_threshold или включено окно digest_window. Сделка не разрывается
+        между сообщениями, поэтому разметка MarkdownV2 каждой части остаётся целой;
+        под пометку о закрытии у каждой части оставлен запас, чтобы сводка
+        не вышла за предел длины при правке
+        """
+        threshold = self.settings.digest_threshold
+        if not self.settings.digest_window and not (threshold and len(pending) >= threshold):
+            return [[item] for item in pending]
+        reserve = max(tlgrm_length(self.closed_text('')), tlgrm_length(self.deprecated_text('')))
+        separator = tlgrm_length(self.digest_separator)
+        packs = []
+        length = 0
+        for item in pending:
+            size = tlgrm_length(item[1]['text']) + reserve
+            if packs and length + separator + size <= TLGRM_MESSAGE_LIMIT:
+                packs[-1].append(item)
+                length += separator + size
+            else:
+                packs.append([item])
+                length = size
+        return packs
+
+    def mark_digest_part(self, digests, deal_in_db, text):
+        if deal_in_db.digest_id not in digests:
+            digest = self.digest.get_by_id(deal_in_db.digest_id)
+            digests[deal_in_db.digest_id] = {
+                'chat': digest.chat,
+                'message_id': digest.message_id,
+                'parts': json.loads(digest.parts),
+                'lock': threading.Lock(),
+            }
+        digest = digests[deal_in_db.digest_id]
+        digest['parts'][deal_in_db.digest_position] = text
+        return digest
+
+    def store_digest_part(self, deal_in_db, text, released=True):
+        """
+        Записывает изменённую часть сводки; сводку без живых сделок больше не храним.
+        released — сделка уходит из сводки (закрыта или получила отдельное сообщение)
+        """
+        digest = self.digest.get_or_none(self.digest.id == deal_in_db.digest_id)
+        if digest is None:
+            return
+        parts = json.loads(digest.parts)
+        parts[deal_in_db.digest_position] = text
+        deals_in_digest = self.deals_db.select(self.deals_db.id).where(self.deals_db.digest_id == digest.id)
+        deals_left = len({
+            deal.id for deal in deals_in_digest
+            if deal.id != deal_in_db.id and deal.id not in self.writes.released
+        })
+        if not released:
+            deals_left += 1
+        if deals_left:
+            digest.parts = json.dumps(parts, ensure_ascii=False)
+            digest.save()
         else:
-            return True
+            self.schedule_sweep(digest.chat, digest.message_id, digest.sent_at)
+            digest.delete_instance()
 
-    def deal_in_deals_opened(self, deal_id):
-        for deal in self.deals_opened:
-            if deal['ID'] == deal_id:
-                return True
-        return False
+    def edit_digest(self, digest):
+        """
+        Переписывает сводку целиком. Текст собирается в момент вызова, поэтому
+        все правки одной сводки за проход уходят с последним её состоянием,
+        а повторная правка тем же текстом (пометка устаревшей части после
+        правки сводки) в Телеграм не уходит
+        """
+        text = self.digest_separator.join(digest['parts'])
+        with digest['lock']:
+            if digest.get('edited') == text:
+                return digest['message_id']
+            message_id = self.bot[digest['chat']].edit_exist_message(digest['message_id'], text)
+            digest['edited'] = text
+        return message_id
 
-    def update_db_and_send_new_deals(self):
-        for deal in self.deals_new:
-            deal_lower = dict_key_lower(deal)
-            category_id = deal_lower['category_id']
-            message_text = self.generate_message(deal=deal_lower)
-            try:
-                message_id = self.bot[category_id].send_text_message(message_text)
-            except KeyError:
-                continue
-            else:
-                deal_lower['message_id'] = message_id
-                deal_lower['message_text'] = message_text
-                self.deals_db.insert(deal_lower).execute()
-                # Задержка из-за ограничения отправки ботом в чят не более 20 сообщений в минуту
-                sleep(3.5)
+    def closed_text(self, text):
+        return f'{self.emoji["check"]}Закрыта\\!\n\n~{text}~'
 
-    def update_db_and_change_assigned(self):
-        for deal in self.deals_change_assigned:
-            deal = dict_key_lower(deal)
-            deal_id = int(deal['id'])
-            assigned_by_id = int(deal['assigned_by_id'])
-            deal_in_db = self.deals_db.get(
-                self.deals_db.id == deal_id,
-            )
-            category_id = deal['category_id']
-            assigned_by_id_old = str(deal_in_db.assigned_by_id)
-            message_text_old = deal_in_db.message_text
-            message_text = self.generate_message(
-                deal=deal,
-                new_message=False,
-                old_responsible_id=assigned_by_id_old
-            )
-            message_id_old = deal_in_db.message_id
-            message_id = self.bot[category_id].send_text_message(message_text)
-            if message_id:
-                self.check_deprecated_message(category_id, message_id_old, message_text_old)
-                deal_in_db.assigned_by_id = assigned_by_id
-                deal_in_db.message_id = message_id
-                deal_in_db.message_text = message_text
-                self.deals_db.bulk_update([deal_in_db], fields=[
-                    self.deals_db.assigned_by_id,
-                    self.deals_db.message_id,
-                    self.deals_db.message_text,
-                ])
-                # Задержка из-за ограничения отправки ботом в чят не более 20 сообщений в минуту
-                sleep(3.5)
-
-    def update_db_and_change_category(self):
-        for deal in self.deals_change_category:
-            deal = dict_key_lower(deal)
-            deal_id = int(deal['id'])
-            category_id = deal['category_id']
-            assigned_by_id = deal['assigned_by_id']
-            deal_in_db = self.deals_db.get(
-                self.deals_db.id == deal_id,
-            )
-            category_id_old = str(deal_in_db.category_id)
-            message_text_old = deal_in_db.message_text
-            message_text = self.generate_message(deal)
-            message_id_old = deal_in_db.message_id
-            try:
-                message_id = self.bot[category_id].send_text_message(message_text)
-            except KeyError:
-                self.check_deprecated_message(category_id_old, message_id_old, message_text_old)
-                deal_in_db.delete_instance()
-            else:
-                self.check_deprecated_message(category_id_old, message_id_old, message_text_old)
-                deal_in_db.category_id = category_id
-                deal_in_db.assigned_by_id = assigned_by_id
-                deal_in_db.message_text = message_text
-                deal_in_db.message_id = message_id
-                self.deals_db.bulk_update([deal_in_db], fields=[
-                    self.deals_db.category_id,
-                    self.deals_db.assigned_by_id,
-                    self.deals_db.message_id,
-                    self.deals_db.message_text,
-                ])
-                # Задержка из-за ограничения отправки ботом в чят не более 20 сообщений в минуту
-                sleep(3.5)
-
-    def check_deprecated_message(self, category_id, message_id, text):
+    def deprecated_text(self, text):
+        return f'{self.emoji["warning"]}Устаревшее сообщение\\!\n\n~{text}~'
+
+    def postpone_delivery(self, operation, error):
+        attempts = operation.attempts + 1
+        delay = min(self.settings.retry_delay * 2 ** (attempts - 1), self.settings.retry_delay_max)
+        print(f'Не удалось выполнить {operation.operation} по сделке {operation.deal_id} '
+              f'(попытка {attempts}, следующая через {delay:.0f} с): {error}')
+        self.outbox.update(attempts=attempts, next_attempt=time() + delay, error=str(error)).where(
+            self.outbox.id == operation.id
+        ).execute()
+
+    def send_and_deprecate(self, category_id, message_text, deprecate):
+        """
+        Отправляет новое сообщение и убирает старое (deprecate). Выполняется в потоке диспетчера.
+        Если для новой категории чат не настроен, только убирает старое и возвращает None
+        """
+        if category_id not in self.bot:
+            deprecate()
+            return None
+        message_id = self.bot[category_id].send_text_message(message_text)
+        if message_id:
+            deprecate()
+        return message_id
+
+    def check_deprecated_message(self, category_id, message_id, text, sent_at=None):
         """
         Бот не может удалить сообщение старше 48 часов
         https://core.telegram.org/bots/api#deletemessage
+        Если время отправки известно, удалять или зачёркивать решается сразу,
+        без заведомо неудачного вызова
         """
         bot = self.bot[category_id]
+        if sent_at is not None and not self.deletable(sent_at):
+            bot.edit_exist_message(message_id, self.deprecated_text(text))
+            return
         try:
             bot.delete_message(message_id)
-        except ApiTelegramException:
-            new_message_text = f'{self.emoji["warning"]}Устаревшее сообщение\!\n\n~{text}~'
-            bot.edit_exist_message(message_id, new_message_text)
+        except ApiTelegramException as exc:
+            if 'message to delete not found' in exc.description:
+                # Уже удалено (например, до сбоя при прошлой попытке)
+                return
+            bot.edit_exist_message(message_id, self.deprecated_text(text))
 
     def generate_message(self, deal, new_message=True, old_responsible_id=None):
-        bitrix24_id = deal['assigned_by_id']
-        deal_id = markdownv2_converter(deal['id'])
-        user_name = self.generate_responsible(bitrix24_id)
-        bid = f'{self.emoji["pin"]}Заявка №*{deal_id}*'
-        if new_message:
-            responsible = f'Ответственный: {user_name}'
-        else:
-            old_user_name = self.generate_responsible(old_responsible_id, new_message)
-            change_responsible = f'{old_user_name} → {user_name}'
-            responsible = f'{self.emoji["recycle"]}Смена ответственного: {change_responsible}'
-        message_text = f'{self.emoji["doc"]}{markdownv2_converter(deal["title"])}'
-        message = f'{bid}\n{responsible}\n\n{message_text}'
-        return message
-
-    def generate_responsible(self, user_id, new_message=True):
-        try:
-            user_name = markdownv2_converter(self.users[user_id]['name'])
-        except KeyError:
-            user_name = 'Неизвестный'
-        if new_message:
-            try:
-                telegram_id = self.settings.tlgrm_id[user_id]
-            except KeyError:
-                name = f'{self.emoji["person"]}__*{user_name}*__'
-            else:
-                name = f'{self.emoji["person"]}[__*{user_name}*__](tg://user?id={telegram_id})'
-        else:
-            name = f'{self.emoji["person"]}__{user_name}__'
-        return name
-
-    def remove_closed_deals(self):
-        for deal in self.deals_db.select():
-            if not self.deal_in_deals_opened(str(deal.id)):
-                category = str(deal.category_id)
-                new_message_text = f'{self.emoji["check"]}Закрыта\\!\n\n~{deal.message_text}~'
-                message_id = self.bot[category].edit_exist_message(deal.message_id, new_message_text)
-                if message_id:
-                    deal.delete_instance()
-
-    def generate_users(self):
-        bitrix24_users = self.connect.get_all(
-            'user.get',
-            params={
-                'select': ['ID', 'NAME', 'LAST_NAME', 'UF_DEPARTMENT'],
-                # 'filter': {'ACTIVE': 'True'}
-            }
-        )
+        return self.renderer.message(deal, new_message, old_responsible_id)
+
+    def generate_users(self, bitrix24_users):
+        users = {}
         for user in bitrix24_users:
             department = str(user["UF_DEPARTMENT"][0])
-            self.users[user['ID']] = {
+            users[user['ID']] = {
                 'name': f'{user["NAME"]} {user["LAST_NAME"]}',
                 'department': department
             }
+        self.users = users
         if not os.path.exists(self.settings.telegram_id_list_file):
             self.settings.create_telegram_id_list(self.users)
 
-    def generate_categories(self):
-        bitrix24_categories = self.connect.get_all(
-            'crm.dealcategory.list',
-            params={
-                'select': ['ID', 'NAME'],
-                'filter': {'IS_LOCKED': 'N'}
-            }
-        )
+    def generate_categories(self, bitrix24_categories):
         for category in bitrix24_categories:
             self.categories[category['ID']] = category['NAME']
         if not os.path.exists(self.settings.category_id_list_file):
             self.settings.create_category_id_list(self.categories)
 
-    def generate_departments(self):
-        bitrix24_departments = self.connect.get_all(
-            'department.get',
-            params={
-                'select': ['ID', 'NAME'],
-            }
-        )
+    def generate_departments(self, bitrix24_departments):
+        departments = {}
         for department in bitrix24_departments:
-            self.departments[department['ID']] = department['NAME']
+            departments[department['ID']] = department['NAME']
+        self.departments = departments
         if not os.path.exists(self.settings.department_id_list_file):
             self.settings.create_department_id_list(self.departments)
 
-    def generate_opened_deals(self):
-        deals_opened = self.connect.get_all(
-            'crm.deal.list',
-            params={
-                'select': ['ID', 'ASSIGNED_BY_ID', 'TITLE', 'COMMENTS', 'DATE_CREATE', 'CATEGORY_ID',],
+    def deals_params(self):
+        if self.full_sync:
+            return {
+                'select': self.deals_select,
                 'filter': {'CLOSED': 'N'}
             }
+        return {
+            'select': self.deals_select,
+            # Нестрогое сравнение: сделки, изменённые в ту же секунду, не теряются
+            'filter': {'>=DATE_MODIFY': datetime.fromisoformat(self.read_sync_state('date_modify')).isoformat()}
+        }
+
+    def generate_opened_deals(self):
+        if self.full_sync:
+            self.generate_opened_deals_full()
+        else:
+            self.generate_opened_deals_incremental()
+
+    def generate_opened_deals_full(self):
+        """
+        Открытые сделки приходят страницами по возрастанию ID, и каждая страница сразу
+        сверяется с отслеживаемыми сделками того же диапазона ID (сделки из БД читаются
+        параллельно, тоже по возрастанию ID). Отслеживаемая сделка из диапазона,
+        которой нет среди открытых, закрыта. В памяти — только текущая страница
+        """
+        tracked = self.tracked_deals()
+        deal_tracked = next(tracked, None)
+        # Неотправленные новые сделки, которые уже не открыты, не нужны
+        pending_new = sorted(
+            row.deal_id for row in self.outbox.select(self.outbox.deal_id).where(self.outbox.operation == 'new')
         )
-        for deal in deals_opened:
-            if self.settings.chat_by_department:
-                category_id = self.users[deal['ASSIGNED_BY_ID']]['department']
-                deal['CATEGORY_ID'] = category_id
-            else:
-                category_id = deal['CATEGORY_ID']
-            if category_id in self.settings.chat_id.keys():
-                self.deals_opened.append(deal)
+        ids_stale = []
+        last_id = 0
+        pages = self.connect.list_pages('crm.deal.list', self.deals_params(), self.deals_first_page)
+        # Пустая страница в конце — хвост отслеживаемых сделок после последней открытой
+        for page in chain(pages, [[]]):
+            page_last_id = int(page[-1]['ID']) if page else None
+            self.deals_opened = {}
+            self.deals_tracked = {}
+            for deal in page:
+                self.add_opened_deal(deal)
+            while deal_tracked is not None and (page_last_id is None or deal_tracked.id <= page_last_id):
+                self.deals_tracked[deal_tracked.id] = deal_tracked
+                deal_tracked = next(tracked, None)
+            pending_from = bisect.bisect_right(pending_new, last_id)
+            pending_to = len(pending_new) if page_last_id is None else bisect.bisect_right(pending_new, page_last_id)
+            ids_stale += [deal_id for deal_id in pending_new[pending_from:pending_to] if deal_id not in self.deals_opened]
+            self.deals_closed_ids = None
+            self.apply_changes()
+            last_id = page_last_id
+        self.drop_pending_new(ids_stale)
+
+    def generate_opened_deals_incremental(self):
+        """
+        Запрашиваются только сделки, изменённые после сохранённой отметки DATE_MODIFY
+        (включая закрытые: закрытие меняет сделку), и сверяются постранично.
+        Запросов столько, сколько страниц изменений, независимо от числа сделок.
+        Удалённые сделки не меняются, их находит полная сверка (full_sync_interval)
+        """
+        self.date_modify = datetime.fromisoformat(self.read_sync_state('date_modify'))
+        pages = self.connect.list_pages('crm.deal.list', self.deals_params(), self.deals_first_page)
+        for page in pages:
+            self.deals_opened = {}
+            self.deals_closed_ids = set()
+            for deal in page:
+                if not self.add_opened_deal(deal):
+                    self.deals_closed_ids.add(int(deal['ID']))
+            self.deals_tracked = self.tracked_deals_by_ids({int(deal['ID']) for deal in page})
+            self.apply_changes()
+
+    def add_opened_deal(self, deal):
+        """
+        Добавляет сделку в открытые компактной записью, если она не закрыта и для неё
+        настроен чат. Попутно сдвигает отметку DATE_MODIFY
+        """
+        date_modify = datetime.fromisoformat(deal['DATE_MODIFY'])
+        if self.date_modify is None or date_modify > self.date_modify:
+            self.date_modify = date_modify
+            self.date_modify_ids = set()
+        if date_modify == self.date_modify:
+            self.date_modify_ids.add(deal['ID'])
+        if deal.get('CLOSED', 'N') == 'Y':
+            return False
+        if self.settings.chat_by_department:
+            user = self.user(deal['ASSIGNED_BY_ID'])
+            category_id = user['department'] if user else None
+        else:
+            category_id = deal['CATEGORY_ID']
+        if category_id in self.settings.chat_id.keys():
+            self.deals_opened[int(deal['ID'])] = DealRecord.from_bitrix(deal, category_id)
+            return True
+        return False
 
 
 class Conf:
+    """
+    Настройки из settings.conf. Для портала из раздела [Portal <имя>] значения этого
+    раздела перекрывают общие, а списки ID, БД и блокировка лежат в подкаталоге <имя>
+    """
+    portal_prefix = 'Portal '
 
-    def __init__(self):
-        self.work_dir = os.path.join(os.getenv('HOME'), '.config', 'Bitrix24toTelegram')
-        self.config_file = os.path.join(self.work_dir, 'settings.conf')
+    def __init__(self, portal=None, base_dir=None):
+        self.portal = portal
+        self.base_dir = base_dir or os.path.join(os.getenv('HOME'), '.config', 'Bitrix24toTelegram')
+        self.config_file = os.path.join(self.base_dir, 'settings.conf')
+        self.work_dir = self.base_dir if portal is None else os.path.join(self.base_dir, portal)
         self.telegram_id_list_file = os.path.join(self.work_dir, 'telegram_id.list')
         self.category_id_list_file = os.path.join(self.work_dir, 'category_id.list')
         self.department_id_list_file = os.path.join(self.work_dir, 'department_id.list')
@@ -401,9 +2354,57 @@ class Conf:
         self.config.read(self.config_file)
         self.botid = self.read_conf('Telegram', 'botid')
         self.chat_by_department = str2bool(self.read_conf('Telegram', 'chat_by_department'))
+        self.chat_rate = float(self.read_conf('Telegram', 'chat_rate', '20'))
+        self.chat_burst = int(self.read_conf('Telegram', 'chat_burst', '1'))
+        self.global_rate = float(self.read_conf('Telegram', 'global_rate', '30'))
+        self.workers = int(self.read_conf('Telegram', 'workers', '8'))
+        self.retry_delay = float(self.read_conf('Telegram', 'retry_delay', '5'))
+        self.retry_delay_max = float(self.read_conf('Telegram', 'retry_delay_max', '3600'))
+        self.pool_size = int(self.read_conf('Telegram', 'pool_size', '10'))
+        self.connect_timeout = float(self.read_conf('Telegram', 'connect_timeout', '15'))
+        self.read_timeout = float(self.read_conf('Telegram', 'read_timeout', '30'))
+        self.digest_threshold = int(self.read_conf('Telegram', 'digest_threshold', '0'))
+        self.digest_window = float(self.read_conf('Telegram', 'digest_window', '0'))
+        self.closed_action = self.read_conf('Telegram', 'closed_action', 'strike').lower()
+        self.sweep = str2bool(self.read_conf('Telegram', 'sweep', 'False'))
+        # Порядок отправки по типам операций: раньше — важнее
+        priority = self.read_conf('Telegram', 'priority', 'new, assigned, category, content, closed')
+        self.priority = {
+            operation.strip().lower(): rank for rank, operation in enumerate(priority.split(',')) if operation.strip()
+        }
+        for operation in ('new', 'assigned', 'category', 'content', 'closed'):
+            self.priority.setdefault(operation, len(self.priority))
         self.webhook = self.read_conf('Bitrix24', 'webhook')
+        self.application_token = self.read_conf('Bitrix24', 'application_token', '')
         self.db_url = self.db_url_insert_path(self.read_conf('System', 'db'))
+        self.sqlite_journal = self.read_conf('System', 'sqlite_journal', 'wal').lower()
+        self.db_batch = int(self.read_conf('System', 'db_batch', '100'))
+        self.db_batch_interval = float(self.read_conf('System', 'db_batch_interval', '1'))
+        self.lock_file = os.path.join(self.work_dir, 'bitrix24totelegram.lock')
+        self.interval = float(self.read_conf('System', 'interval', '60'))
+        self.jitter = float(self.read_conf('System', 'jitter', '10'))
+        self.users_ttl = float(self.read_conf('System', 'users_ttl', '3600'))
+        self.categories_ttl = float(self.read_conf('System', 'categories_ttl', '86400'))
+        self.departments_ttl = float(self.read_conf('System', 'departments_ttl', '86400'))
+        self.push_host = self.read_conf('System', 'push_host', '127.0.0.1')
+        self.push_port = int(self.read_conf('System', 'push_port', '8080'))
+        self.push_debounce = float(self.read_conf('System', 'push_debounce', '2'))
+        self.push_max_delay = float(self.read_conf('System', 'push_max_delay', '10'))
+        self.metrics_host = self.read_conf('System', 'metrics_host', '127.0.0.1')
+        self.metrics_port = int(self.read_conf('System', 'metrics_port', '0'))
+        self.metrics_log = str2bool(self.read_conf('System', 'metrics_log', 'False'))
+        self.sync_mode = self.read_conf('System', 'sync_mode', 'full').lower()
+        self.full_sync_interval = int(self.read_conf('System', 'full_sync_interval', '3600'))
+        self.health_ttl = float(self.read_conf('System', 'health_ttl', '300'))
+        self.health_file = os.path.join(self.work_dir, 'health.json')
+        self.portal_workers = int(self.read_conf('System', 'portal_workers', '4'))
+        self.portals = [
+            section[len(self.portal_prefix):].strip()
+            for section in self.config.sections()
+            if section.startswith(self.portal_prefix)
+        ]
         self.tlgrm_id = {}
+        self.tlgrm_id_mtime = None
         self.chat_id = {}
         self.category_id = {}
         self.department_id = {}
@@ -412,8 +2413,7 @@ class Conf:
         self.generate_ids()
 
     def generate_ids(self):
-        if os.path.exists(self.telegram_id_list_file):
-            self.tlgrm_id = read_id_list(self.telegram_id_list_file, self.re_tlgrm_id)
+        self.reload_tlgrm_id()
         if os.path.exists(self.category_id_list_file):
             self.category_id = read_id_list(self.category_id_list_file, self.re_chat_id)
         if os.path.exists(self.department_id_list_file):
@@ -423,9 +2423,27 @@ class Conf:
         else:
             self.chat_id = self.category_id
 
+    def reload_tlgrm_id(self):
+        """
+        Перечитывает telegram_id.list, если файл изменился (по mtime): долгоживущие
+        режимы видят правки без перезапуска. Словарь обновляется на месте, на него
+        ссылается MessageRenderer. Возвращает True, если список перечитан
+        """
+        try:
+            mtime = os.stat(self.telegram_id_list_file).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.tlgrm_id_mtime:
+            return False
+        self.tlgrm_id_mtime = mtime
+        tlgrm_id = read_id_list(self.telegram_id_list_file, self.re_tlgrm_id) if mtime is not None else {}
+        self.tlgrm_id.clear()
+        self.tlgrm_id.update(tlgrm_id)
+        return True
+
     def exist(self):
         if not os.path.isdir(self.work_dir):
-            os.mkdir(self.work_dir)
+            os.makedirs(self.work_dir)
         if not os.path.exists(self.config_file):
             try:
                 self.create_conf()
@@ -438,8 +2456,42 @@ class Conf:
         self.config.add_section('System')
         self.config.set('Telegram', 'botid', '000000000:00000000000000000000000000000000000')
         self.config.set('Telegram', 'chat_by_department', 'False')
+        self.config.set('Telegram', 'chat_rate', '20')
+        self.config.set('Telegram', 'chat_burst', '1')
+        self.config.set('Telegram', 'global_rate', '30')
+        self.config.set('Telegram', 'workers', '8')
+        self.config.set('Telegram', 'retry_delay', '5')
+        self.config.set('Telegram', 'retry_delay_max', '3600')
+        self.config.set('Telegram', 'pool_size', '10')
+        self.config.set('Telegram', 'connect_timeout', '15')
+        self.config.set('Telegram', 'read_timeout', '30')
+        self.config.set('Telegram', 'digest_threshold', '0')
+        self.config.set('Telegram', 'digest_window', '0')
+        self.config.set('Telegram', 'closed_action', 'strike')
+        self.config.set('Telegram', 'sweep', 'False')
+        self.config.set('Telegram', 'priority', 'new, assigned, category, content, closed')
         self.config.set('Bitrix24', 'webhook', 'https://0000000000.bitrix24.ru/rest/00/0000000000000000/')
         self.config.set('System', 'db', 'sqlite:///bitrix24deals.db')
+        self.config.set('System', 'sqlite_journal', 'wal')
+        self.config.set('System', 'db_batch', '100')
+        self.config.set('System', 'db_batch_interval', '1')
+        self.config.set('System', 'interval', '60')
+        self.config.set('System', 'jitter', '10')
+        self.config.set('System', 'users_ttl', '3600')
+        self.config.set('System', 'categories_ttl', '86400')
+        self.config.set('System', 'departments_ttl', '86400')
+        self.config.set('Bitrix24', 'application_token', '')
+        self.config.set('System', 'push_host', '127.0.0.1')
+        self.config.set('System', 'push_port', '8080')
+        self.config.set('System', 'push_debounce', '2')
+        self.config.set('System', 'push_max_delay', '10')
+        self.config.set('System', 'metrics_host', '127.0.0.1')
+        self.config.set('System', 'metrics_port', '0')
+        self.config.set('System', 'metrics_log', 'False')
+        self.config.set('System', 'sync_mode', 'full')
+        self.config.set('System', 'full_sync_interval', '3600')
+        self.config.set('System', 'portal_workers', '4')
+        self.config.set('System', 'health_ttl', '300')
         with open(self.config_file, 'w') as config_file:
             self.config.write(config_file)
         raise FileNotFoundError(f'Требуется внести данные в конфиг: {self.config_file}')
@@ -483,13 +2535,22 @@ class Conf:
             f'<ID Bitrix24>=<ID чата Телеграм>#<Название отдела/department (или любой другой текст)>'
         )
 
-    def read_conf(self, section, setting):
-        value = self.config.get(section, setting)
+    def read_conf(self, section, setting, fallback=None):
+        portal_section = f'{self.portal_prefix}{self.portal}'
+        if self.portal is not None and self.config.has_option(portal_section, setting):
+            return self.config.get(portal_section, setting)
+        if fallback is None:
+            value = self.config.get(section, setting)
+        else:
+            value = self.config.get(section, setting, fallback=fallback)
         return value
 
     def db_url_insert_path(self, db_url):
         pattern = r'(^[A-z]*:\/\/\/)(.*$)'
         parse = re.match(pattern, db_url)
+        if parse is None:
+            # Сетевая БД (mysql://, postgresql://): путь подставлять некуда
+            return db_url
         prefix = parse.group(1)
         db_name = parse.group(2)
         path = os.path.join(self.work_dir, db_name)
@@ -497,15 +2558,100 @@ class Conf:
         return db_converted_url
 
 
-class TlgrmBot:
+tlgrm_clients = {}
+tlgrm_clients_lock = threading.Lock()
+
+
+def tlgrm_client(settings):
+    """
+    Клиент Телеграма для токена из настроек: один на токен на весь процесс
+    """
+    with tlgrm_clients_lock:
+        if settings.botid not in tlgrm_clients:
+            tlgrm_clients[settings.botid] = TlgrmClient(
+                botid=settings.botid,
+                limiter=RateLimiter(
+                    chat_rate=settings.chat_rate / 60,
+                    chat_burst=settings.chat_burst,
+                    global_rate=settings.global_rate,
+                ),
+                pool_size=settings.pool_size,
+                connect_timeout=settings.connect_timeout,
+                read_timeout=settings.read_timeout,
+                health=HealthCache(settings.health_file, settings.health_ttl),
+            )
+        return tlgrm_clients[settings.botid]
+
 
-    def __init__(self, botid, chatid):
+def delete_messages(token, chat_id, message_ids):
+    """
+    deleteMessages (Bot API 7.0): в pyTelegramBotAPI 4.7 обёртки ещё нет
+    """
+    params = {'chat_id': chat_id, 'message_ids': json.dumps(message_ids)}
+    return apihelper._make_request(token, 'deleteMessages', params=params, method='post')
+
+
+class TlgrmClient:
+    """
+    Клиент бота: общий TeleBot, ограничитель скорости и пул keep-alive соединений
+    для всех чатов, проверка get_me выполняется один раз.
+    HTTP-транспорт pyTelegramBotAPI глобален для модуля apihelper,
+    поэтому пул соединений с api.telegram.org общий для всех токенов процесса
+    """
+
+    def __init__(self, botid, limiter=None, pool_size=10, connect_timeout=15, read_timeout=30, health=None):
+        import requests
+        import requests.adapters
+        load_telebot()
         self.botid = botid
-        self.chatid = chatid
         self.bot = TeleBot(self.botid)
+        self.limiter = limiter or RateLimiter()
+        self.health = health
+        self.is_alive = None
+        if apihelper.session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            apihelper.session = session
+            # Сессия живёт всё время работы процесса, а не 10 минут
+            apihelper.SESSION_TIME_TO_LIVE = None
+        apihelper.CONNECT_TIMEOUT = connect_timeout
+        apihelper.READ_TIMEOUT = read_timeout
+
+    def alive(self):
+        if self.is_alive is None:
+            if self.health is None:
+                self.is_alive = self.get_me()
+            else:
+                # В файле — не токен, а его хеш
+                token_hash = hashlib.sha256(self.botid.encode()).hexdigest()[:16]
+                self.is_alive = self.health.probe(f'telegram {token_hash}', self.get_me)
+        return self.is_alive
+
+    def get_me(self):
+        try:
+            captured('telegram', 'get_me', self.bot.get_me)
+        except Exception:
+            return False
+        return True
+
+
+class TlgrmBot:
+    """
+    Лёгкий дескриптор чата поверх общего TlgrmClient
+    """
+
+    def __init__(self, client, chatid):
+        self.client = client
+        self.chatid = chatid
+        self.bot = client.bot
+        self.limiter = client.limiter
 
     def send_text_message(self, text):
-        message = self.bot.send_message(
+        message = self.limiter.call(
+            self.chatid,
+            self.bot.send_message,
             chat_id=self.chatid,
             text=text,
             parse_mode='MarkdownV2',
@@ -514,32 +2660,368 @@ class TlgrmBot:
         return message.message_id
 
     def edit_exist_message(self, message_id, message_text):
-        message = self.bot.edit_message_text(
-            text=message_text,
-            chat_id=self.chatid,
-            message_id=message_id,
-            parse_mode='MarkdownV2',
-            disable_web_page_preview=True,
-        )
+        try:
+            message = self.limiter.call(
+                self.chatid,
+                self.bot.edit_message_text,
+                text=message_text,
+                chat_id=self.chatid,
+                message_id=message_id,
+                parse_mode='MarkdownV2',
+                disable_web_page_preview=True,
+            )
+        except ApiTelegramException as exc:
+            if 'message is not modified' in exc.description:
+                # Такой текст уже стоит (например, до сбоя при прошлой попытке)
+                return message_id
+            raise
         return message.message_id
 
     def delete_message(self, message_id):
-        self.bot.delete_message(
+        self.limiter.call(
+            self.chatid,
+            self.bot.delete_message,
             chat_id=self.chatid,
             message_id=message_id,
         )
 
+    def delete_messages(self, message_ids):
+        """
+        Удаляет сообщения пачками по 100 одним вызовом deleteMessages (ненайденные
+        Телеграм пропускает). Если сервер Bot API метода не знает — по одному
+        """
+        for ids_chunk in peewee.chunked(message_ids, TLGRM_DELETE_BATCH):
+            try:
+                self.limiter.call(self.chatid, delete_messages, self.bot.token, self.chatid, list(ids_chunk))
+            except ApiTelegramException as exc:
+                if exc.error_code != 404 and 'method not found' not in exc.description.lower():
+                    raise
+                for message_id in ids_chunk:
+                    try:
+                        self.delete_message(message_id)
+                    except ApiTelegramException as exc:
+                        if 'message to delete not found' not in exc.description:
+                            raise
+        return True
+
     def alive(self):
+        return self.client.alive()
+
+
+class DeliveryWorker(threading.Thread):
+    """
+    Поток, разбирающий Outbox: просыпается после записи новых операций
+    или к сроку ближайшей отложенной
+    """
+
+    def __init__(self, parser):
+        super().__init__(name='outbox', daemon=True)
+        self.parser = parser
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.clear()
+            try:
+                self.parser.deliver_outbox()
+            except Exception as exc:
+                print(f'Ошибка доставки: {exc}')
+            self.wake.wait(self.timeout())
+        self.parser.db.close()
+
+    def timeout(self):
+        outbox = self.parser.outbox
+        sweep = self.parser.sweep
+        moments = [
+            outbox.select(peewee.fn.MIN(outbox.next_attempt)).scalar(),
+            sweep.select(peewee.fn.MIN(sweep.delete_at)).scalar(),
+        ]
+        moments = [moment for moment in moments if moment is not None]
+        if not moments:
+            return self.parser.settings.interval
+        next_attempt = min(moments)
+        return min(max(next_attempt - time(), 0.1), self.parser.settings.interval)
+
+    def stop(self):
+        # Начатая доставка дорабатывает до конца
+        self.stopped.set()
+        self.wake.set()
+        self.join()
+
+
+class Daemon:
+    """
+    Долгоживущий режим: один Bitrix24Parser с тёплыми кешами и сессиями,
+    циклы синхронизации раз в interval секунд плюс случайный jitter
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.stop = threading.Event()
+        self.parser = Bitrix24Parser(settings, persistent=True)
+        self.parser.start_delivery()
+
+    def handle_signal(self, signum, frame):
+        # Текущий цикл дорабатывает до конца, новый уже не начинается
+        self.stop.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        if not self.parser.bot_alive:
+            print('Бот Телеграма недоступен')
+            self.parser.close()
+            return
+        while not self.stop.is_set():
+            try:
+                self.parser.run_cycle()
+            except Exception as exc:
+                print(f'Ошибка цикла синхронизации: {exc}')
+            self.stop.wait(self.settings.interval + random.uniform(0, self.settings.jitter))
+        self.parser.close()
+
+
+class Portals:
+    """
+    Несколько порталов в одном процессе: у каждого профиля [Portal <имя>] свой
+    Bitrix24Parser со своей БД, списками ID и блокировкой. Циклы выполняются в пуле
+    из portal_workers потоков: медленный или упавший портал занимает один поток
+    и не задерживает остальные. Профили с одним токеном бота делят общий клиент
+    Телеграма и его ограничитель скорости (tlgrm_client)
+    """
+
+    def __init__(self, settings, persistent=False):
+        self.settings = settings
+        self.persistent = persistent
+        self.stop = threading.Event()
+        self.pool = ThreadPoolExecutor(max_workers=settings.portal_workers, thread_name_prefix='portal')
+        self.parsers = {}
+
+    def handle_signal(self, signum, frame):
+        # Начатые циклы дорабатывают до конца, новые уже не начинаются
+        self.stop.set()
+
+    def run_portal(self, name):
+        parser = self.parsers.get(name)
+        if parser is None:
+            parser = Bitrix24Parser(Conf(name, self.settings.base_dir), persistent=self.persistent)
+            self.parsers[name] = parser
+            if self.persistent:
+                parser.start_delivery()
+        if not parser.bot_alive:
+            print(f'[{name}] Бот Телеграма недоступен')
+            return
+        if self.persistent or parser.online:
+            parser.run_cycle()
+
+    def interval(self, name):
+        parser = self.parsers.get(name)
+        settings = parser.settings if parser is not None else self.settings
+        return settings.interval + random.uniform(0, settings.jitter)
+
+    def run(self):
+        """
+        Без persistent — один цикл по каждому порталу. С persistent — постоянно:
+        следующий цикл портала начинается через interval (+ jitter) после конца
+        предыдущего, и два цикла одного портала не идут одновременно
+        """
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        next_run = {name: 0 for name in self.settings.portals}
+        running = {}
+        while next_run or running:
+            now = monotonic()
+            for name, moment in list(next_run.items()):
+                if moment <= now and not self.stop.is_set():
+                    del next_run[name]
+                    running[self.pool.submit(self.run_portal, name)] = name
+            done, _ = wait(list(running), timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    print(f'[{name}] Ошибка цикла синхронизации: {future.exception()}')
+                if self.persistent:
+                    next_run[name] = monotonic() + self.interval(name)
+            if self.stop.is_set() or not self.persistent:
+                next_run = {}
+            elif not running:
+                self.stop.wait(min(max(min(next_run.values()) - monotonic(), 0), 1))
+        self.pool.shutdown()
+        for parser in self.parsers.values():
+            parser.close()
+
+
+class PushReceiver:
+    """
+    Режим push: HTTP-сервер для исходящих вебхуков Битрикс24
+    (ONCRMDEALADD, ONCRMDEALUPDATE, ONCRMDEALDELETE).
+    События копятся по ID сделки: после push_debounce секунд тишины
+    (но не позже push_max_delay от первого события) пачка сделок
+    обрабатывается одним циклом. Раз в full_sync_interval секунд
+    выполняется обычный цикл для сверки пропущенного. Очередь Outbox,
+    как и в режиме демона, разбирается в фоне (DeliveryWorker)
+    """
+
+    events = {'ONCRMDEALADD', 'ONCRMDEALUPDATE', 'ONCRMDEALDELETE'}
+
+    def __init__(self, settings, parser=None):
+        load_asyncio()
+        self.settings = settings
+        # Парсер живёт в отдельном потоке: его синхронные вызовы Битрикс24 крутят свою петлю asyncio
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.parser = parser or self.executor.submit(Bitrix24Parser, settings, True).result()
+        if self.parser.delivery is None:
+            # Отложенные отправки и окно сводки не ждут следующего события или сверки
+            self.parser.start_delivery()
+        self.pending = {}
+        self.timers = {}
+        self.ready = set()
+        self.processing = None
+        self.stop = None
+
+    async def handle_event(self, request):
+        form = await request.post()
+        token = form.get('auth[application_token]', '')
+        if not hmac.compare_digest(token.encode(), self.settings.application_token.encode()):
+            return aiohttp.web.Response(status=403)
+        if form.get('event', '').upper() not in self.events:
+            return aiohttp.web.Response(status=400)
         try:
-            self.bot.get_me()
-        except Exception:
-            return False
+            deal_id = int(form['data[FIELDS][ID]'])
+        except (KeyError, ValueError):
+            return aiohttp.web.Response(status=400)
+        self.schedule(deal_id)
+        return aiohttp.web.Response(text='OK')
+
+    def schedule(self, deal_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        first_seen = self.pending.setdefault(deal_id, now)
+        if deal_id in self.timers:
+            self.timers[deal_id].cancel()
+        delay = min(self.settings.push_debounce, first_seen + self.settings.push_max_delay - now)
+        self.timers[deal_id] = loop.call_later(max(delay, 0), self.mark_ready, deal_id)
+
+    def mark_ready(self, deal_id):
+        self.timers.pop(deal_id, None)
+        self.pending.pop(deal_id, None)
+        self.ready.add(deal_id)
+        if self.processing is None or self.processing.done():
+            self.processing = asyncio.ensure_future(self.process_ready())
+
+    async def process_ready(self):
+        loop = asyncio.get_running_loop()
+        while self.ready:
+            deal_ids, self.ready = self.ready, set()
+            try:
+                done = await loop.run_in_executor(self.executor, self.parser.run_cycle, deal_ids)
+            except Exception as exc:
+                print(f'Ошибка обработки событий по сделкам {sorted(deal_ids)}: {exc}')
+                continue
+            if not done:
+                # Идёт другой цикл — попробуем ещё раз чуть позже
+                self.ready.update(deal_ids)
+                await asyncio.sleep(self.settings.push_debounce)
+
+    async def reconcile(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(self.executor, self.parser.run_cycle)
+            except Exception as exc:
+                print(f'Ошибка цикла синхронизации: {exc}')
+            await asyncio.sleep(self.settings.full_sync_interval)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop.set)
+        app = aiohttp.web.Application()
+        app.router.add_post('/{tail:.*}', self.handle_event)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, self.settings.push_host, self.settings.push_port)
+        await site.start()
+        reconcile = asyncio.ensure_future(self.reconcile())
+        await self.stop.wait()
+        reconcile.cancel()
+        await runner.cleanup()
+        # Всё, что успело прийти, обрабатываем перед выходом
+        for deal_id in list(self.timers):
+            self.timers[deal_id].cancel()
+            self.mark_ready(deal_id)
+        if self.processing is not None:
+            await self.processing
+
+    def run(self):
+        if not self.settings.application_token:
+            print(f'Требуется внести application_token исходящего вебхука в конфиг: {self.settings.config_file}')
+        elif not self.parser.bot_alive:
+            print('Бот Телеграма недоступен')
         else:
-            return True
+            asyncio.run(self.serve())
+        self.executor.submit(self.parser.close).result()
+        self.executor.shutdown()
 
 
-if __name__ == '__main__':
-    config = Conf()
-    btrx24 = Bitrix24Parser(config)
+async def create_bitrix_session():
+    return aiohttp.ClientSession(raise_for_status=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Оповещения из Битрикс24 в Телеграм')
+    parser.add_argument('--daemon', action='store_true', help='работать постоянно, без cron')
+    parser.add_argument('--push', action='store_true', help='принимать события из исходящего вебхука Битрикс24')
+    parser.add_argument('--record', metavar='FILE', help='один цикл с записью ответов Битрикс24 и Телеграма в FILE')
+    parser.add_argument('--replay', metavar='FILE', help='один цикл без сети по записи из FILE')
+    parser.add_argument('--profile', metavar='FILE', help='профиль цикла (cProfile) в FILE')
+    return parser.parse_args()
+
+
+def run_once(settings, args):
+    btrx24 = Bitrix24Parser(settings)
+    if args.record:
+        capture.snapshot(btrx24.db)
     if btrx24.online and btrx24.bot_alive:
-        btrx24.run()
+        if args.profile:
+            profiled(args.profile, btrx24.run_cycle)
+        else:
+            btrx24.run_cycle()
+    btrx24.close()
+
+
+def main():
+    args = parse_args()
+    if args.replay:
+        config = enable_capture(args.replay, replaying=True)
+    else:
+        config = Conf()
+    enable_metrics(config)
+    if args.record:
+        enable_capture(args.record, config)
+    if args.record or args.replay or args.profile:
+        try:
+            run_once(config, args)
+        finally:
+            # Запись дописывается, временный каталог воспроизведения удаляется
+            if capture is not None:
+                capture.close()
+    elif config.portals:
+        if args.push:
+            print('Режим push с несколькими порталами не поддерживается')
+        else:
+            Portals(config, persistent=args.daemon).run()
+    elif args.push:
+        PushReceiver(config).run()
+    elif args.daemon:
+        Daemon(config).run()
+    elif not idle_check(config):
+        btrx24 = Bitrix24Parser(config)
+        if btrx24.online and btrx24.bot_alive:
+            btrx24.run_cycle()
+
+
+if __name__ == '__main__':
+    main()
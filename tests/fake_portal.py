@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+Обвязка тестов доставки: Bitrix24Parser во временном каталоге против имитаций
+Битрикс24 и Телеграма из tools/benchmark.py
+"""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+import Bitrix24toTlgrm  # noqa: E402
+from benchmark import Portal, Counters, FakeServer, BitrixHandler, TelegramHandler, write_config  # noqa: E402
+
+
+class PortalTestCase(unittest.TestCase):
+    """
+    size — открытых сделок на портале, options — настройки вида Раздел.ключ=значение
+    """
+    size = 20
+    options = []
+
+    def setUp(self):
+        self.portal = Portal(self.size)
+        self.counters = Counters()
+        self.bitrix = FakeServer(BitrixHandler, self.portal, self.counters)
+        self.telegram = FakeServer(TelegramHandler, self.portal, self.counters)
+        bitrix_url = self.bitrix.start()
+        telegram_url = self.telegram.start()
+        self.addCleanup(self.stop_server, self.bitrix)
+        self.addCleanup(self.stop_server, self.telegram)
+        home = tempfile.TemporaryDirectory()
+        self.addCleanup(home.cleanup)
+        write_config(home.name, bitrix_url, False, self.options)
+        Bitrix24toTlgrm.load_telebot()
+        Bitrix24toTlgrm.apihelper.API_URL = telegram_url + '/bot{0}/{1}'
+        self.addCleanup(self.reset_telegram)
+        with redirect_stdout(io.StringIO()):
+            settings = Bitrix24toTlgrm.Conf(base_dir=os.path.join(home.name, '.config', 'Bitrix24toTelegram'))
+            self.parser = Bitrix24toTlgrm.Bitrix24Parser(settings)
+        self.addCleanup(self.parser.close)
+
+    @staticmethod
+    def stop_server(server):
+        server.shutdown()
+        server.server_close()
+
+    @staticmethod
+    def reset_telegram():
+        # Клиент Телеграма и его сессия общие на процесс: каждый тест начинает со своих
+        Bitrix24toTlgrm.tlgrm_clients.clear()
+        if Bitrix24toTlgrm.apihelper.session is not None:
+            Bitrix24toTlgrm.apihelper.session.close()
+            Bitrix24toTlgrm.apihelper.session = None
+
+    def quiet(self, func, *args):
+        """
+        Вызов парсера без вывода в консоль (подсказки по спискам ID, отложенные операции)
+        """
+        with redirect_stdout(io.StringIO()):
+            return func(*args)
+
+    def cycle(self):
+        self.quiet(self.parser.run)
+
+    def deliver(self):
+        self.quiet(self.parser.deliver)
+
+    def calls(self, method):
+        return self.counters.snapshot().get(f'telegram_{method}', 0)
+
+    def opened(self):
+        """
+        ID открытых сделок портала в настроенных чатах
+        """
+        with self.portal.lock:
+            return {
+                deal_id for deal_id, deal in self.portal.deals.items()
+                if deal['CLOSED'] == 'N' and deal['CATEGORY_ID'] in self.parser.bot
+            }
+
+    def tracked(self):
+        return {deal.id: deal for deal in self.parser.deals_db.select()}
+
+    def outbox(self):
+        return list(self.parser.outbox.select().order_by(self.parser.outbox.id))
+
+    def modify(self, deal_id, **fields):
+        with self.portal.lock:
+            deal = self.portal.deals[deal_id]
+            deal.update(fields)
+            deal['DATE_MODIFY'] = self.portal.tick()
+
+    def add_deals(self, count, category_id='0'):
+        deal_ids = []
+        with self.portal.lock:
+            for _ in range(count):
+                self.portal.add_deal()
+                self.portal.deals[self.portal.last_id]['CATEGORY_ID'] = category_id
+                deal_ids.append(self.portal.last_id)
+        return deal_ids
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""
+Сверка открытых сделок с отслеживаемыми (DealsDiff).
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from datetime import datetime
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Bitrix24toTlgrm import DealRecord, DealsDiff  # noqa: E402
+
+Tracked = namedtuple('Tracked', 'id category_id assigned_by_id title')
+
+
+def opened(*deals):
+    return {deal_id: DealRecord(deal_id, category_id, assigned_by_id, title, datetime(2022, 11, 1))
+            for deal_id, category_id, assigned_by_id, title in deals}
+
+
+def tracked(*deals):
+    return {deal[0]: Tracked(*deal) for deal in deals}
+
+
+class DealsDiffTest(unittest.TestCase):
+
+    def test_full(self):
+        diff = DealsDiff(
+            opened((1, 0, 1, 'a'), (2, 2, 1, 'b'), (3, 0, 2, 'c'), (4, 0, 1, 'новое'), (5, 0, 1, 'e'), (7, 0, 1, 'g')),
+            tracked((1, 0, 1, 'a'), (2, 0, 1, 'b'), (3, 0, 1, 'c'), (4, 0, 1, 'd'), (5, 0, 1, 'e'), (6, 0, 1, 'f')),
+        )
+        self.assertEqual(diff.new, [7])
+        self.assertEqual(diff.closed, [6])
+        self.assertEqual(diff.change_category, [2])
+        self.assertEqual(diff.change_assigned, [3])
+        self.assertEqual(diff.change_content, [4])
+
+    def test_one_change_per_deal(self):
+        # Смена категории важнее смены ответственного, та — смены названия
+        diff = DealsDiff(
+            opened((1, 2, 2, 'b'), (2, 0, 2, 'b')),
+            tracked((1, 0, 1, 'a'), (2, 0, 1, 'a')),
+        )
+        self.assertEqual(diff.change_category, [1])
+        self.assertEqual(diff.change_assigned, [2])
+        self.assertEqual(diff.change_content, [])
+
+    def test_incremental_closed_ids(self):
+        # Открытые — только изменённые: закрытыми считаются лишь явно переданные
+        diff = DealsDiff(
+            opened((1, 0, 1, 'a')),
+            tracked((1, 0, 1, 'a'), (2, 0, 1, 'b'), (3, 0, 1, 'c')),
+            closed_ids={3, 4},
+        )
+        self.assertEqual(diff.new, [])
+        self.assertEqual(diff.closed, [3])
+
+    def test_reopened_not_closed(self):
+        diff = DealsDiff(opened((1, 0, 1, 'a')), tracked((1, 0, 1, 'a')), closed_ids={1})
+        self.assertEqual(diff.closed, [])
+
+    def test_empty(self):
+        diff = DealsDiff({}, {})
+        self.assertEqual((diff.new, diff.closed, diff.change_category), ([], [], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
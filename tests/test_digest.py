@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+Сводки новых сделок: раскладка по сообщениям, правка частей при закрытии,
+смене ответственного и названия, одна правка сообщения на сводку за проход.
+Запуск: python -m unittest discover tests
+"""
+
+import json
+import unittest
+
+from fake_portal import Bitrix24toTlgrm, PortalTestCase
+
+
+class DigestTest(PortalTestCase):
+    options = ['Telegram.digest_threshold=3']
+
+    def setUp(self):
+        super().setUp()
+        self.cycle()
+        self.deal_ids = self.add_deals(4)
+        sent = self.calls('sendMessage')
+        self.cycle()
+        self.assertEqual(self.calls('sendMessage') - sent, 1)
+        tracked = self.tracked()
+        self.digest_id = tracked[self.deal_ids[0]].digest_id
+        self.assertIsNotNone(self.digest_id)
+        self.assertEqual([tracked[deal_id].digest_id for deal_id in self.deal_ids], [self.digest_id] * 4)
+        self.assertEqual([tracked[deal_id].digest_position for deal_id in self.deal_ids], [0, 1, 2, 3])
+        self.texts = [tracked[deal_id].message_text for deal_id in self.deal_ids]
+        self.assertEqual(self.parts(), self.texts)
+
+    def digest(self):
+        return self.parser.digest.get_or_none(self.parser.digest.id == self.digest_id)
+
+    def parts(self):
+        return json.loads(self.digest().parts)
+
+    def changed(self, *changes):
+        """
+        Изменения в портале и один цикл; возвращает число отправок и правок
+        """
+        sent, edited = self.calls('sendMessage'), self.calls('editMessageText')
+        for deal_id, fields in changes:
+            self.modify(deal_id, **fields)
+        self.cycle()
+        self.assertEqual(self.outbox(), [])
+        return self.calls('sendMessage') - sent, self.calls('editMessageText') - edited
+
+    def test_close(self):
+        first, second, third, fourth = self.deal_ids
+        self.assertEqual(self.changed((first, {'CLOSED': 'Y'}), (third, {'CLOSED': 'Y'})), (0, 1))
+        parts = self.parts()
+        self.assertEqual(parts[0], self.parser.closed_text(self.texts[0]))
+        self.assertEqual(parts[1], self.texts[1])
+        self.assertEqual(parts[2], self.parser.closed_text(self.texts[2]))
+        tracked = self.tracked()
+        self.assertNotIn(first, tracked)
+        self.assertNotIn(third, tracked)
+        # Сводка без живых сделок больше не хранится
+        self.assertEqual(self.changed((second, {'CLOSED': 'Y'}), (fourth, {'CLOSED': 'Y'})), (0, 1))
+        self.assertIsNone(self.digest())
+
+    def test_reassign(self):
+        deal_id = self.deal_ids[1]
+        old_responsible = self.tracked()[deal_id].assigned_by_id
+        responsible = next(user for user in self.portal.users if int(user) != old_responsible)
+        self.assertEqual(self.changed((deal_id, {'ASSIGNED_BY_ID': responsible})), (1, 1))
+        row = self.tracked()[deal_id]
+        # Сделка получила отдельное сообщение, её часть в сводке зачёркнута
+        self.assertIsNone(row.digest_id)
+        self.assertEqual(row.assigned_by_id, int(responsible))
+        self.assertIn('Смена ответственного', row.message_text)
+        parts = self.parts()
+        self.assertEqual(parts[1], self.parser.deprecated_text(self.texts[1]))
+        self.assertEqual(parts[0], self.texts[0])
+
+    def test_title(self):
+        deal_id = self.deal_ids[2]
+        self.assertEqual(self.changed((deal_id, {'TITLE': 'Новое название'})), (0, 1))
+        row = self.tracked()[deal_id]
+        self.assertEqual(row.digest_id, self.digest_id)
+        self.assertEqual(self.parts()[2], row.message_text)
+        self.assertTrue(row.message_text.endswith('Новое название'))
+
+    def test_one_edit_per_digest(self):
+        first, second, third, fourth = self.deal_ids
+        responsible = next(user for user in self.portal.users if int(user) != self.tracked()[fourth].assigned_by_id)
+        sent, edited = self.changed(
+            (first, {'CLOSED': 'Y'}),
+            (second, {'CLOSED': 'Y'}),
+            (third, {'TITLE': 'Новое название'}),
+            (fourth, {'ASSIGNED_BY_ID': responsible}),
+        )
+        # Все правки сводки за проход уходят одним editMessageText
+        self.assertEqual((sent, edited), (1, 1))
+        parts = self.parts()
+        self.assertEqual(parts[:2], [self.parser.closed_text(text) for text in self.texts[:2]])
+        self.assertTrue(parts[2].endswith('Новое название'))
+        self.assertEqual(parts[3], self.parser.deprecated_text(self.texts[3]))
+
+
+class PackDigestsTest(PortalTestCase):
+    options = ['Telegram.digest_threshold=3']
+
+    def pending(self, *lengths):
+        return [(index, {'text': 'а' * length}, None) for index, length in enumerate(lengths)]
+
+    def test_below_threshold(self):
+        self.assertEqual(self.parser.pack_digests(self.pending(10, 10)), [[item] for item in self.pending(10, 10)])
+
+    def test_message_limit(self):
+        pending = self.pending(1500, 1500, 1500, 100, 4000)
+        packs = self.parser.pack_digests(pending)
+        # Порядок сохраняется, сделка не разрывается между сообщениями
+        self.assertEqual([item for pack in packs for item in pack], pending)
+        self.assertEqual([[index for index, payload, job in pack] for pack in packs], [[0, 1], [2, 3], [4]])
+        for pack in packs[:-1]:
+            # С запасом под пометку о закрытии каждой части сводка остаётся в пределе длины
+            text = self.parser.digest_separator.join(self.parser.closed_text(payload['text']) for _, payload, _ in pack)
+            self.assertLessEqual(Bitrix24toTlgrm.tlgrm_length(text), Bitrix24toTlgrm.TLGRM_MESSAGE_LIMIT)
+
+
+if __name__ == '__main__':
+    unittest.main()
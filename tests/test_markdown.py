@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Экранирование MarkdownV2, тексты сообщений MessageRenderer и перечитывание telegram_id.list.
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import sys
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Bitrix24toTlgrm import EMOJI, MARKDOWNV2_SPECIAL, Conf, DealRecord, MessageRenderer, markdownv2_converter  # noqa: E402
+
+# Символы из https://core.telegram.org/bots/api#markdownv2-style
+SPECIAL = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+
+
+def legacy_converter(text):
+    """
+    Прежнее экранирование: по проходу str.replace на символ
+    """
+    for symbol in SPECIAL:
+        text = text.replace(symbol, '\\' + symbol)
+    return text
+
+
+class MarkdownV2ConverterTest(unittest.TestCase):
+
+    def test_special_set(self):
+        self.assertEqual(sorted(MARKDOWNV2_SPECIAL), sorted(SPECIAL))
+
+    def test_each_special_character(self):
+        for symbol in SPECIAL:
+            with self.subTest(symbol=symbol):
+                self.assertEqual(markdownv2_converter(symbol), '\\' + symbol)
+                self.assertEqual(markdownv2_converter(f'а{symbol}б'), f'а\\{symbol}б')
+                self.assertEqual(markdownv2_converter(symbol * 3), ('\\' + symbol) * 3)
+
+    def test_all_special_characters_together(self):
+        text = ''.join(SPECIAL)
+        self.assertEqual(markdownv2_converter(text), ''.join('\\' + symbol for symbol in SPECIAL))
+
+    def test_plain_text_unchanged(self):
+        for text in ('', 'Иван Петров', 'abc 123', '🧑\n\t', '\\'):
+            with self.subTest(text=text):
+                self.assertEqual(markdownv2_converter(text), text)
+
+    def test_same_as_legacy(self):
+        rnd = random.Random(1)
+        alphabet = ''.join(SPECIAL) + '\\ abcXYZ0123456789абвгдЁё\n\t🧑'
+        for _ in range(2000):
+            text = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 60)))
+            self.assertEqual(markdownv2_converter(text), legacy_converter(text), text)
+
+
+class MessageRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.users = {
+            '1': {'name': 'Иван Петров-Водкин', 'department': '1'},
+            '2': {'name': 'Anna_Smith (QA)', 'department': '1'},
+        }
+        self.tlgrm_id = {'1': '1000001'}
+        self.renderer = MessageRenderer(self.user, self.tlgrm_id)
+
+    def user(self, user_id):
+        return self.users.get(user_id)
+
+    def test_new_message(self):
+        deal = DealRecord(15, 0, 1, 'Заявка (срочно!)', None)
+        self.assertEqual(
+            self.renderer.message(deal),
+            f'{EMOJI["pin"]}Заявка №*15*\n'
+            f'Ответственный: {EMOJI["person"]}[__*Иван Петров\\-Водкин*__](tg://user?id=1000001)\n\n'
+            f'{EMOJI["doc"]}Заявка \\(срочно\\!\\)',
+        )
+
+    def test_change_responsible(self):
+        deal = DealRecord(7, 0, 2, 'a.b', None)
+        self.assertEqual(
+            self.renderer.message(deal, new_message=False, old_responsible_id='1'),
+            f'{EMOJI["pin"]}Заявка №*7*\n'
+            f'{EMOJI["recycle"]}Смена ответственного: {EMOJI["person"]}__Иван Петров\\-Водкин__ → '
+            f'{EMOJI["person"]}__*Anna\\_Smith \\(QA\\)*__\n\n'
+            f'{EMOJI["doc"]}a\\.b',
+        )
+
+    def test_unknown_user(self):
+        self.assertEqual(self.renderer.responsible('9'), f'{EMOJI["person"]}__*Неизвестный*__')
+        self.users['9'] = {'name': 'Новый Сотрудник', 'department': '1'}
+        # Незнакомый пользователь не кешируется
+        self.assertEqual(self.renderer.responsible('9'), f'{EMOJI["person"]}__*Новый Сотрудник*__')
+
+    def test_cache_and_invalidate(self):
+        first = self.renderer.responsible('2')
+        self.users['2'] = {'name': 'Anna Smith', 'department': '1'}
+        self.assertEqual(self.renderer.responsible('2'), first)
+        self.renderer.invalidate()
+        self.assertEqual(self.renderer.responsible('2'), f'{EMOJI["person"]}__*Anna Smith*__')
+
+    def test_telegram_id_change(self):
+        self.renderer.responsible('2')
+        self.tlgrm_id['2'] = '1000002'
+        self.assertEqual(
+            self.renderer.responsible('2'),
+            f'{EMOJI["person"]}[__*Anna\\_Smith \\(QA\\)*__](tg://user?id=1000002)',
+        )
+
+
+class TelegramIdReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.base_dir.cleanup)
+        self.write_list('1=1000001#Иван Петров\n2=#Anna Smith\n', 1)
+        self.settings = Conf(base_dir=self.base_dir.name)
+
+    def write_list(self, text, mtime):
+        path = os.path.join(self.base_dir.name, 'telegram_id.list')
+        with open(path, 'w') as list_file:
+            list_file.write(text)
+        os.utime(path, (mtime, mtime))
+
+    def test_reload_on_change(self):
+        tlgrm_id = self.settings.tlgrm_id
+        self.assertEqual(tlgrm_id, {'1': '1000001'})
+        self.assertFalse(self.settings.reload_tlgrm_id())
+        self.write_list('1=1000001#Иван Петров\n2=1000002#Anna Smith\n', 2)
+        self.assertTrue(self.settings.reload_tlgrm_id())
+        # Словарь тот же: MessageRenderer видит правку без пересоздания
+        self.assertIs(self.settings.tlgrm_id, tlgrm_id)
+        self.assertEqual(tlgrm_id, {'1': '1000001', '2': '1000002'})
+
+    def test_renderer_after_reload(self):
+        users = {'2': {'name': 'Anna Smith', 'department': '1'}}
+        renderer = MessageRenderer(users.get, self.settings.tlgrm_id)
+        self.assertEqual(renderer.responsible('2'), f'{EMOJI["person"]}__*Anna Smith*__')
+        self.write_list('2=1000002#Anna Smith\n', 2)
+        self.settings.reload_tlgrm_id()
+        self.assertEqual(renderer.responsible('2'), f'{EMOJI["person"]}[__*Anna Smith*__](tg://user?id=1000002)')
+
+
+if __name__ == '__main__':
+    unittest.main()
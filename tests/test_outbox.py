@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Очередь Outbox: повторная доставка после ошибок Телеграма и БД, пауза между попытками,
+идемпотентность и порядок операций одной сделки в разных чатах.
+Запуск: python -m unittest discover tests
+"""
+
+import json
+import threading
+import unittest
+from time import sleep, time
+from types import SimpleNamespace
+from unittest import mock
+
+import peewee
+
+from fake_portal import Bitrix24toTlgrm, PortalTestCase
+
+
+class OutboxTest(PortalTestCase):
+    options = ['Telegram.retry_delay=5', 'Telegram.retry_delay_max=15', 'System.db_batch=5']
+
+    def setUp(self):
+        super().setUp()
+        self.cycle()
+        self.assertEqual(set(self.tracked()), self.opened())
+
+    def failing(self, method, failures, exc=None):
+        """
+        Подменяет метод TlgrmBot: первые failures вызовов падают, остальные идут в имитацию
+        """
+        original = getattr(Bitrix24toTlgrm.TlgrmBot, method)
+        left = [failures]
+        lock = threading.Lock()
+
+        def call(bot, *args):
+            with lock:
+                fail = left[0] > 0
+                left[0] -= fail
+            if fail:
+                raise exc or ConnectionError('Телеграм недоступен')
+            return original(bot, *args)
+
+        return mock.patch.object(Bitrix24toTlgrm.TlgrmBot, method, call)
+
+    def make_due(self):
+        self.parser.outbox.update(next_attempt=0).execute()
+
+    def test_redelivery_after_telegram_error(self):
+        deal_ids = self.add_deals(5)
+        sent = self.calls('sendMessage')
+        with self.failing('send_text_message', 1):
+            self.cycle()
+        [row] = self.outbox()
+        self.assertIn(row.deal_id, deal_ids)
+        self.assertEqual(row.attempts, 1)
+        self.assertAlmostEqual(row.next_attempt, time() + 5, delta=2)
+        self.assertIn('Телеграм недоступен', row.error)
+        self.assertEqual(self.calls('sendMessage') - sent, 4)
+        # Пауза ещё не прошла — операция не повторяется
+        self.deliver()
+        self.assertEqual(len(self.outbox()), 1)
+        self.make_due()
+        self.deliver()
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(self.calls('sendMessage') - sent, 5)
+        self.assertEqual(set(self.tracked()), self.opened())
+
+    def test_backoff(self):
+        self.add_deals(1)
+        delays = []
+        with self.failing('send_text_message', 4):
+            self.cycle()
+            for _ in range(4):
+                [row] = self.outbox()
+                delays.append(round(row.next_attempt - time()))
+                self.make_due()
+                self.deliver()
+        self.assertEqual(delays, [5, 10, 15, 15])
+        self.assertEqual(self.outbox(), [])
+
+    def test_redelivery_after_db_error(self):
+        # Результаты уже отправленных сообщений не теряются, если запись в БД не прошла
+        deals = self.parser.deals_db
+        insert_many = deals.insert_many
+        left = [1]
+
+        def failing_insert(rows, fields=None):
+            if left[0]:
+                left[0] -= 1
+                raise peewee.OperationalError('database is locked')
+            return insert_many(rows, fields)
+
+        self.add_deals(20)
+        sent = self.calls('sendMessage')
+        with mock.patch.object(deals, 'insert_many', side_effect=failing_insert):
+            self.cycle()
+        self.assertEqual(self.calls('sendMessage') - sent, 20)
+        self.cycle()
+        self.assertEqual(self.calls('sendMessage') - sent, 20)
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(set(self.tracked()), self.opened())
+
+    def test_pending_batch_blocks_sending(self):
+        # Пока пачка прошлого прохода не записана, новые отправки не начинаются
+        self.add_deals(3)
+        with mock.patch.object(self.parser.deals_db, 'insert_many', side_effect=peewee.OperationalError('locked')):
+            with self.assertRaises(peewee.OperationalError):
+                self.cycle()
+            sent = self.calls('sendMessage')
+            self.make_due()
+            with self.assertRaises(peewee.OperationalError):
+                self.deliver()
+            self.assertEqual(self.calls('sendMessage'), sent)
+        self.deliver()
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(self.calls('sendMessage'), sent)
+        self.assertEqual(set(self.tracked()), self.opened())
+
+    def test_idempotent_redelivery(self):
+        # Операции, чьё содержимое уже в Телеграме, снимаются с очереди без вызова
+        deal = next(iter(self.tracked().values()))
+        with self.portal.lock:
+            record = Bitrix24toTlgrm.DealRecord.from_bitrix(self.portal.deals[deal.id])
+        payload = json.dumps(self.parser.payload(record), ensure_ascii=False)
+        for operation in ('new', 'content'):
+            self.parser.outbox.insert(
+                key=f'{deal.id}:{operation}', deal_id=deal.id, operation=operation, chat=str(deal.category_id),
+                payload=payload, created=time(),
+            ).execute()
+        calls = self.counters.snapshot().get('telegram', 0)
+        self.deliver()
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(self.counters.snapshot().get('telegram', 0), calls)
+        self.assertEqual(self.tracked()[deal.id].message_id, deal.message_id)
+
+    def test_same_deal_across_chats(self):
+        # Правка в старом чате и перенос в новый не выполняются одновременно
+        deal = next(iter(self.tracked().values()))
+        category_id = next(chat for chat in self.parser.bot if chat != str(deal.category_id))
+        with mock.patch.object(self.parser, 'delivery', SimpleNamespace(wake=threading.Event())):
+            self.modify(deal.id, TITLE='Новое название')
+            self.cycle()
+            self.modify(deal.id, CATEGORY_ID=category_id)
+            self.cycle()
+        self.assertEqual([row.operation for row in self.outbox()], ['content', 'category'])
+        edit = Bitrix24toTlgrm.TlgrmBot.edit_exist_message
+
+        def slow_edit(bot, *args):
+            sleep(0.3)
+            return edit(bot, *args)
+
+        with mock.patch.object(Bitrix24toTlgrm.TlgrmBot, 'edit_exist_message', slow_edit):
+            self.deliver()
+        row = self.tracked()[deal.id]
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(str(row.category_id), category_id)
+        self.assertNotEqual(row.message_id, deal.message_id)
+        self.assertEqual(row.title, 'Новое название')
+
+    def test_closed_before_delivery(self):
+        # Сделка закрылась, пока ждала отправки: оповещение о ней не уходит
+        deal_id, = self.add_deals(1)
+        sent = self.calls('sendMessage')
+        with self.failing('send_text_message', 1):
+            self.cycle()
+        self.modify(deal_id, CLOSED='Y')
+        self.cycle()
+        self.make_due()
+        self.deliver()
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(self.calls('sendMessage'), sent)
+        self.assertNotIn(deal_id, self.tracked())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Бенчмарк поиска изменений в сделках на 1k, 10k и 100k сделок так, как это делает
+полная сверка: открытые сделки приходят страницами по возрастанию ID, отслеживаемые
+читаются из БД порциями (Bitrix24Parser.tracked_deals), каждая страница сверяется
+со своим диапазоном ID (DealsDiff). Выводится время и пик памяти (tracemalloc).
+С --legacy — также сверка всей таблицы разом и прежний алгоритм (медленно).
+
+Запуск: python tools/bench_diff.py [--legacy] [--sizes 1000 10000 100000]
+"""
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import peewee  # noqa: E402
+from Bitrix24toTlgrm import BITRIX_PAGE_SIZE, Bitrix24Parser, Deals, DealRecord, DealsDiff, db_proxy  # noqa: E402
+
+CATEGORIES = ['6', '8', '10']
+USERS = [str(user_id) for user_id in range(1, 200)]
+
+
+def generate_portal(size, churn):
+    """
+    Генерирует отслеживаемые сделки для БД и открытые сделки из «Битрикс24»,
+    отличающиеся на долю churn (новые, закрытые, смена категории и ответственного)
+    """
+    rnd = random.Random(size)
+    changed = int(size * churn)
+    rows = []
+    for deal_id in range(1, size + 1):
+        rows.append({
+            'id': deal_id,
+            'category_id': int(rnd.choice(CATEGORIES)),
+            'assigned_by_id': int(rnd.choice(USERS)),
+            'date_create': datetime(2022, 1, 1),
+            'title': f'Сделка {deal_id}',
+            'message_id': deal_id,
+            'message_text': f'Сделка {deal_id}',
+        })
+    deals_opened = {}
+    for row in rows[changed:]:
+        deals_opened[row['id']] = DealRecord(
+            row['id'], row['category_id'], row['assigned_by_id'], row['title'], row['date_create']
+        )
+    for deal_id in range(size + 1, size + changed + 1):
+        deals_opened[deal_id] = DealRecord(deal_id, 6, 1, f'Сделка {deal_id}', datetime(2022, 1, 1))
+    changed_ids = rnd.sample(sorted(deals_opened.keys() & {row['id'] for row in rows}), changed)
+    for deal_id in changed_ids[:changed // 2]:
+        deals_opened[deal_id].category_id = 999
+    for deal_id in changed_ids[changed // 2:]:
+        deals_opened[deal_id].assigned_by_id = 999
+    return rows, deals_opened
+
+
+def cycle_streaming(deals_opened):
+    """
+    Слияние страниц открытых сделок с отслеживаемыми, как в generate_opened_deals_full
+    """
+    parser = SimpleNamespace(
+        deals_db=Deals,
+        deals_tracked_fields=[Deals.id, Deals.category_id, Deals.assigned_by_id, Deals.title],
+    )
+    tracked = Bitrix24Parser.tracked_deals(parser)
+    deal_tracked = next(tracked, None)
+    ids_opened = sorted(deals_opened)
+    pages = [ids_opened[start:start + BITRIX_PAGE_SIZE] for start in range(0, len(ids_opened), BITRIX_PAGE_SIZE)]
+    new = change_category = change_assigned = closed = 0
+    # Пустая страница в конце — хвост отслеживаемых сделок после последней открытой
+    for page in pages + [[]]:
+        page_last_id = page[-1] if page else None
+        page_opened = {deal_id: deals_opened[deal_id] for deal_id in page}
+        page_tracked = {}
+        while deal_tracked is not None and (page_last_id is None or deal_tracked.id <= page_last_id):
+            page_tracked[deal_tracked.id] = deal_tracked
+            deal_tracked = next(tracked, None)
+        diff = DealsDiff(page_opened, page_tracked)
+        new += len(diff.new)
+        change_category += len(diff.change_category)
+        change_assigned += len(diff.change_assigned)
+        closed += len(diff.closed)
+    return new, change_category, change_assigned, closed
+
+
+def cycle_table(deals_opened):
+    deals_tracked = {deal.id: deal for deal in Deals.select()}
+    diff = DealsDiff(deals_opened, deals_tracked)
+    return len(diff.new), len(diff.change_category), len(diff.change_assigned), len(diff.closed)
+
+
+def cycle_legacy(deals_opened):
+    """
+    Прежний алгоритм: до трёх запросов на открытую сделку и линейный поиск по открытым
+    """
+    opened = list(deals_opened.values())
+    new = change_category = change_assigned = closed = 0
+    for deal in opened:
+        try:
+            deal_db = Deals.get(Deals.id == deal.id)
+        except Deals.DoesNotExist:
+            new += 1
+            continue
+        if deal_db.category_id != deal.category_id:
+            change_category += 1
+        elif deal_db.assigned_by_id != deal.assigned_by_id:
+            change_assigned += 1
+    for deal_db in Deals.select():
+        if not any(deal.id == deal_db.id for deal in opened):
+            closed += 1
+    return new, change_category, change_assigned, closed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--churn', type=float, default=0.01)
+    parser.add_argument('--legacy', action='store_true',
+                        help='замерить и сверку всей таблицы, и прежний алгоритм (медленно)')
+    args = parser.parse_args()
+    print(f'{"deals":>8} {"algorithm":>10} {"seconds":>9} {"peak, MB":>9}  new/category/assigned/closed')
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = peewee.SqliteDatabase(os.path.join(tmp_dir, 'bench.db'))
+            db_proxy.initialize(db)
+            db.create_tables([Deals])
+            rows, deals_opened = generate_portal(size, args.churn)
+            with db.atomic():
+                for batch in peewee.chunked(rows, 500):
+                    Deals.insert_many(batch).execute()
+            algorithms = [('stream', cycle_streaming)]
+            if args.legacy:
+                algorithms += [('table', cycle_table), ('legacy', cycle_legacy)]
+            for name, cycle in algorithms:
+                tracemalloc.start()
+                started = perf_counter()
+                result = cycle(deals_opened)
+                elapsed = perf_counter() - started
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+                print(f'{size:>8} {name:>10} {elapsed:>9.3f} {peak:>9.1f}  {"/".join(map(str, result))}')
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
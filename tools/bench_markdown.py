@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Микробенчмарк текстов сообщений в MarkdownV2: markdownv2_converter (один проход
+str.translate) и MessageRenderer (шаблон и LRU-кеш ответственных) против прежней
+реализации (18 проходов str.replace, фрагменты без кеша). Замеряется время на
+--deals сообщений: названия как у сделок портала (редкие спецсимволы) и строки,
+где спецсимволов много. Совпадение текстов проверяет tests/test_markdown.py.
+
+Запуск: python tools/bench_markdown.py [--deals 100000] [--users 200] [--repeat 3]
+"""
+
+import os
+import sys
+import random
+import argparse
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Bitrix24toTlgrm import EMOJI, MARKDOWNV2_SPECIAL, DealRecord, MessageRenderer, markdownv2_converter  # noqa: E402
+
+LEGACY_SYMBOLS = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+
+
+def legacy_converter(text):
+    for symbol in LEGACY_SYMBOLS:
+        text = text.replace(symbol, '\\' + symbol)
+    return text
+
+
+class LegacyRenderer:
+    """
+    Прежние generate_message и generate_responsible из Bitrix24Parser
+    """
+
+    def __init__(self, user, tlgrm_id):
+        self.user = user
+        self.tlgrm_id = tlgrm_id
+
+    def message(self, deal, new_message=True, old_responsible_id=None):
+        deal_id = legacy_converter(str(deal.id))
+        user_name = self.responsible(str(deal.assigned_by_id))
+        bid = f'{EMOJI["pin"]}Заявка №*{deal_id}*'
+        if new_message:
+            responsible = f'Ответственный: {user_name}'
+        else:
+            old_user_name = self.responsible(old_responsible_id, new_message)
+            responsible = f'{EMOJI["recycle"]}Смена ответственного: {old_user_name} → {user_name}'
+        return f'{bid}\n{responsible}\n\n{EMOJI["doc"]}{legacy_converter(deal.title)}'
+
+    def responsible(self, user_id, new_message=True):
+        user = self.user(user_id)
+        user_name = legacy_converter(user['name']) if user else 'Неизвестный'
+        if new_message:
+            try:
+                telegram_id = self.tlgrm_id[user_id]
+            except KeyError:
+                return f'{EMOJI["person"]}__*{user_name}*__'
+            return f'{EMOJI["person"]}[__*{user_name}*__](tg://user?id={telegram_id})'
+        return f'{EMOJI["person"]}__{user_name}__'
+
+
+def dense_text(rnd, length):
+    alphabet = MARKDOWNV2_SPECIAL + ' abcXYZ0123456789абвгдЁё'
+    return ''.join(rnd.choice(alphabet) for _ in range(length))
+
+
+def generate(rnd, users_count, deals_count, dense):
+    users = {
+        str(user_id): {'name': f'Имя{user_id} Фамилия-{user_id}', 'department': '1'}
+        for user_id in range(1, users_count + 1)
+    }
+    tlgrm_id = {user_id: str(1000000 + int(user_id)) for user_id in users if int(user_id) % 2}
+    deals = []
+    for deal_id in range(1, deals_count + 1):
+        if dense:
+            title = dense_text(rnd, 40)
+        else:
+            title = f'Заявка от клиента №{deal_id} (срочно!) [{rnd.randint(1, 999)}]'
+        deals.append(DealRecord(deal_id, 0, rnd.randint(1, users_count), title, None))
+    return users, tlgrm_id, deals
+
+
+def bench(render, items, repeat):
+    best = None
+    for _ in range(repeat):
+        started = perf_counter()
+        for item in items:
+            render(item)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--deals', type=int, default=100000, help='сообщений в замере')
+    parser.add_argument('--users', type=int, default=200, help='пользователей в справочнике')
+    parser.add_argument('--repeat', type=int, default=3, help='повторов, берётся лучший')
+    args = parser.parse_args()
+    print(f'{"titles":>8} {"step":>10} {"legacy, s":>10} {"current, s":>10} {"ratio":>6}')
+    for dense in (False, True):
+        users, tlgrm_id, deals = generate(random.Random(1), args.users, args.deals, dense)
+        titles = [deal.title for deal in deals]
+        steps = (
+            ('escape', legacy_converter, markdownv2_converter, titles),
+            ('message', LegacyRenderer(users.get, tlgrm_id).message, MessageRenderer(users.get, tlgrm_id).message, deals),
+        )
+        for step, legacy, current, items in steps:
+            legacy_time = bench(legacy, items, args.repeat)
+            current_time = bench(current, items, args.repeat)
+            print(f'{"dense" if dense else "portal":>8} {step:>10} {legacy_time:>10.3f} {current_time:>10.3f} '
+                  f'{legacy_time / current_time:>6.2f}')
+
+
+if __name__ == '__main__':
+    main()
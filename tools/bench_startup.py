@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Бенчмарк запуска из cron: импорт модуля и однократный запуск (python Bitrix24toTlgrm.py)
+против имитаций Битрикс24 и Телеграма из tools/benchmark.py, sync_mode = incremental.
+
+Сценарии, каждый в отдельном процессе от запуска интерпретатора до выхода:
+    import  — только import Bitrix24toTlgrm (за вычетом пустого запуска python);
+    idle    — в Битрикс24 ничего не изменилось, очередь пуста: цикл пропускается
+              после дешёвой проверки (idle_check);
+    changed — изменилась доля сделок, выполняется полный цикл.
+Для каждого запуска выводится, были ли загружены telebot, fast_bitrix24 и aiohttp.
+
+Пример:
+    python tools/bench_startup.py --size 1000 --runs 5
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from time import perf_counter
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import ROOT, Portal, Counters, FakeServer, BitrixHandler, TelegramHandler, write_config
+
+HEAVY_MODULES = ('telebot', 'fast_bitrix24', 'aiohttp')
+
+
+def child(args):
+    """
+    Запуск как из cron; адрес Телеграма подменяется при ленивой загрузке telebot
+    """
+    sys.path.insert(0, ROOT)
+    import Bitrix24toTlgrm
+
+    load_telebot = Bitrix24toTlgrm.load_telebot
+
+    def load_local_telebot():
+        load_telebot()
+        Bitrix24toTlgrm.apihelper.API_URL = args.telegram_url + '/bot{0}/{1}'
+
+    Bitrix24toTlgrm.load_telebot = load_local_telebot
+    sys.argv = [Bitrix24toTlgrm.__file__]
+    Bitrix24toTlgrm.main()
+    print(json.dumps({name: name in sys.modules for name in HEAVY_MODULES}))
+
+
+def timed(command, env=None):
+    started = perf_counter()
+    process = subprocess.run(command, env=env, capture_output=True, text=True)
+    elapsed = perf_counter() - started
+    if process.returncode:
+        raise RuntimeError(process.stderr)
+    return elapsed, process.stdout
+
+
+def run_cron(home, telegram_url):
+    env = dict(os.environ, HOME=home)
+    elapsed, stdout = timed(
+        [sys.executable, os.path.abspath(__file__), '--child', '--telegram-url', telegram_url], env=env,
+    )
+    return elapsed, json.loads(stdout.strip().splitlines()[-1])
+
+
+def report(name, times, modules=None):
+    loaded = ', '.join(name for name, imported in (modules or {}).items() if imported) or '—'
+    print(f'{name:>8} {median(times) * 1000:>10.1f} {min(times) * 1000:>9.1f} {loaded}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1000, help='открытых сделок на портале')
+    parser.add_argument('--runs', type=int, default=5, help='запусков на сценарий')
+    parser.add_argument('--churn', type=float, default=0.01, help='доля изменившихся сделок в сценарии changed')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--telegram-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+    print(f'{"scenario":>8} {"median, ms":>10} {"min, ms":>9} загружены')
+    bare = [timed([sys.executable, '-c', 'pass'])[0] for _ in range(args.runs)]
+    imports = [
+        timed([sys.executable, '-c', 'import Bitrix24toTlgrm'], env=dict(os.environ, PYTHONPATH=ROOT))[0]
+        for _ in range(args.runs)
+    ]
+    report('import', [spent - median(bare) for spent in imports])
+    portal = Portal(args.size)
+    counters = Counters()
+    bitrix = FakeServer(BitrixHandler, portal, counters)
+    telegram = FakeServer(TelegramHandler, portal, counters)
+    bitrix_url = bitrix.start()
+    telegram_url = telegram.start()
+    try:
+        with tempfile.TemporaryDirectory() as home:
+            write_config(home, bitrix_url, False, ['System.sync_mode=incremental'])
+            # Первый запуск — полная сверка, второй сохраняет отметку после неё
+            run_cron(home, telegram_url)
+            run_cron(home, telegram_url)
+            for scenario in ('idle', 'changed'):
+                times = []
+                before = counters.snapshot()
+                for _ in range(args.runs):
+                    if scenario == 'changed':
+                        portal.churn(args.churn)
+                    elapsed, modules = run_cron(home, telegram_url)
+                    times.append(elapsed)
+                report(scenario, times, modules)
+                after = counters.snapshot()
+                print(f'{"":>8} REST http за {args.runs} запусков: {after.get("rest_http", 0) - before.get("rest_http", 0)}')
+    finally:
+        bitrix.shutdown()
+        telegram.shutdown()
+
+
+if __name__ == '__main__':
+    main()
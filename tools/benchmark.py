@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Офлайн-бенчмарк цикла синхронизации: Bitrix24Parser.run против локальных
+имитаций REST API Битрикс24 (crm.deal.list, user.get, department.get,
+crm.dealcategory.list, batch; постранично по 50 строк) и Bot API Телеграма
+(sendMessage, editMessageText, deleteMessage, deleteMessages; с задержкой и ответами 429).
+
+Для каждого сценария (cold — пустая БД, steady — без изменений, churn — доля
+сделок изменилась) в отдельном процессе сначала готовится состояние, затем
+замеряется один цикл: время, вызовы REST, вызовы Телеграма, SQL-запросы, пик памяти.
+
+Примеры:
+    python tools/benchmark.py --sizes 1000 10000
+    python tools/benchmark.py --save-baseline tools/benchmark_baseline.json
+    python tools/benchmark.py --check tools/benchmark_baseline.json
+"""
+
+import os
+import re
+import sys
+import json
+import random
+import logging
+import argparse
+import tempfile
+import resource
+import threading
+import subprocess
+from time import sleep, perf_counter
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE_SIZE = 50
+BOT_TOKEN = '123456:BENCHMARK'
+CATEGORIES = ['0', '2', '4', '6', '8']
+DEPARTMENTS = ['1', '3', '5', '7']
+
+
+def parse_php_query(query):
+    """
+    Разбирает строку запроса вида filter[CLOSED]=N&select[0]=ID во вложенные словари и списки
+    """
+    result = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+', key)
+        node = result
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return lists_from_dicts(result)
+
+
+def lists_from_dicts(node):
+    if isinstance(node, dict):
+        node = {key: lists_from_dicts(value) for key, value in node.items()}
+        if node and all(key.isdigit() for key in node):
+            return [node[key] for key in sorted(node, key=int)]
+    return node
+
+
+class Portal:
+    """
+    Синтетический портал: пользователи, категории, отделы и сделки
+    """
+
+    def __init__(self, size, closed_share=0.5, seed=1):
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.now = datetime(2022, 11, 1, 9, 0, 0)
+        self.users = {
+            str(user_id): {
+                'ID': str(user_id),
+                'NAME': f'Имя{user_id}',
+                'LAST_NAME': f'Фамилия-{user_id}',
+                'UF_DEPARTMENT': [int(self.rnd.choice(DEPARTMENTS))],
+            }
+            for user_id in range(1, max(10, size // 100) + 1)
+        }
+        self.categories = [{'ID': category_id, 'NAME': f'Категория {category_id}'} for category_id in CATEGORIES[1:]]
+        self.departments = [{'ID': department_id, 'NAME': f'Отдел {department_id}'} for department_id in DEPARTMENTS]
+        self.deals = {}
+        self.last_id = 0
+        total = int(size / (1 - closed_share))
+        for _ in range(total):
+            self.add_deal(closed='Y' if self.rnd.random() < closed_share else 'N')
+
+    def tick(self):
+        self.now += timedelta(seconds=1)
+        return self.now.strftime('%Y-%m-%dT%H:%M:%S+03:00')
+
+    def add_deal(self, closed='N'):
+        self.last_id += 1
+        moment = self.tick()
+        self.deals[self.last_id] = {
+            'ID': str(self.last_id),
+            'ASSIGNED_BY_ID': self.rnd.choice(list(self.users)),
+            'TITLE': f'Заявка от клиента №{self.last_id} (срочно!) [{self.rnd.randint(1, 999)}]',
+            'COMMENTS': 'Комментарий менеджера. ' * self.rnd.randint(0, 20),
+            'DATE_CREATE': moment,
+            'CATEGORY_ID': self.rnd.choice(CATEGORIES),
+            'DATE_MODIFY': moment,
+            'CLOSED': closed,
+        }
+
+    def churn(self, share):
+        """
+        Меняет долю открытых сделок: поровну новых, закрытых, смен ответственного и категории
+        """
+        with self.lock:
+            opened = [deal for deal in self.deals.values() if deal['CLOSED'] == 'N']
+            changed = self.rnd.sample(opened, min(len(opened), int(len(opened) * share)))
+            for index, deal in enumerate(changed):
+                kind = index % 4
+                if kind == 0:
+                    self.add_deal()
+                    continue
+                if kind == 1:
+                    deal['CLOSED'] = 'Y'
+                elif kind == 2:
+                    deal['ASSIGNED_BY_ID'] = self.rnd.choice(list(self.users))
+                else:
+                    deal['CATEGORY_ID'] = self.rnd.choice(CATEGORIES)
+                deal['DATE_MODIFY'] = self.tick()
+
+    def select_deals(self, params):
+        flt = params.get('filter', {})
+        ids = {int(deal_id) for deal_id in flt.get('@ID', [])} if '@ID' in flt else None
+        with self.lock:
+            rows = []
+            for deal_id in sorted(self.deals):
+                deal = self.deals[deal_id]
+                if ids is not None and deal_id not in ids:
+                    continue
+                if 'CLOSED' in flt and deal['CLOSED'] != flt['CLOSED']:
+                    continue
+                if '>=DATE_MODIFY' in flt and deal['DATE_MODIFY'] < flt['>=DATE_MODIFY']:
+                    continue
+                if '>ID' in flt and deal_id <= int(flt['>ID']):
+                    continue
+                rows.append(deal)
+        select = (params.get('select') or list(rows[0])) if rows else []
+        return [{key: deal[key] for key in select if key in deal} for deal in rows]
+
+    def list_method(self, method, params):
+        if method == 'crm.deal.list':
+            return self.select_deals(params)
+        if method == 'user.get':
+            flt = params.get('filter', {})
+            return [user for user in self.users.values() if 'ID' not in flt or user['ID'] == str(flt['ID'])]
+        if method == 'department.get':
+            return self.departments
+        if method == 'crm.dealcategory.list':
+            return self.categories
+        raise KeyError(method)
+
+    def page(self, method, params):
+        """
+        Ответ в формате Битрикс24: 50 строк, total и next. start=-1 — без подсчёта total
+        """
+        rows = self.list_method(method, params)
+        start = int(params.get('start', 0))
+        if start == -1:
+            return {'result': rows[:PAGE_SIZE]}
+        response = {'result': rows[start:start + PAGE_SIZE], 'total': len(rows)}
+        if start + PAGE_SIZE < len(rows):
+            response['next'] = start + PAGE_SIZE
+        return response
+
+
+class Counters:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, portal, counters, latency=0, rate_429=0, seed=1):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.portal = portal
+        self.counters = counters
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rnd = random.Random(seed)
+        self.message_id = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело уходят разными write: без TCP_NODELAY keep-alive
+    # упирается в Nagle и отложенный ACK (~40 мс на запрос)
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        self.do_POST()
+
+
+class BitrixHandler(Handler):
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == '/':
+            return self.reply({})
+        if self.server.latency:
+            sleep(self.server.latency)
+        method = urlparse(self.path).path.rstrip('/').rsplit('/', 1)[-1]
+        params = json.loads(body) if body else {}
+        self.server.counters.add('rest_http')
+        portal = self.server.portal
+        if method != 'batch':
+            self.server.counters.add('rest_commands')
+            return self.reply(portal.page(method, params))
+        result = {'result': {}, 'result_error': [], 'result_total': {}, 'result_next': {}, 'result_time': {}}
+        for label, command in params['cmd'].items():
+            self.server.counters.add('rest_commands')
+            command_method, _, query = command.partition('?')
+            page = portal.page(command_method, parse_php_query(query))
+            result['result'][label] = page['result']
+            if 'total' in page:
+                result['result_total'][label] = page['total']
+            if 'next' in page:
+                result['result_next'][label] = page['next']
+        self.reply({'result': result})
+
+
+class TelegramHandler(Handler):
+
+    def do_POST(self):
+        body = self.read_body()
+        url = urlparse(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+        params = dict(parse_qsl(url.query))
+        params.update(parse_qsl(body.decode()))
+        server = self.server
+        if method == 'getMe':
+            return self.reply({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench'}})
+        if server.latency:
+            sleep(server.latency)
+        server.counters.add('telegram')
+        with server.lock:
+            limited = server.rnd.random() < server.rate_429
+            server.message_id += 1
+            message_id = server.message_id
+        if limited:
+            server.counters.add('telegram_429')
+            return self.reply({
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            }, status=429)
+        server.counters.add(f'telegram_{method}')
+        if method in ('deleteMessage', 'deleteMessages'):
+            return self.reply({'ok': True, 'result': True})
+        if method == 'editMessageText':
+            message_id = int(params.get('message_id', 0))
+        self.reply({'ok': True, 'result': {
+            'message_id': message_id,
+            'date': 0,
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'supergroup'},
+            'text': params.get('text', ''),
+        }})
+
+
+def write_config(home, bitrix_url, telegram_limits, extra):
+    work_dir = os.path.join(home, '.config', 'Bitrix24toTelegram')
+    os.makedirs(work_dir, exist_ok=True)
+    chat_rate, global_rate = ('20', '30') if telegram_limits else ('1000000', '1000000')
+    settings = {
+        'Telegram': {
+            'botid': BOT_TOKEN, 'chat_by_department': 'False',
+            'chat_rate': chat_rate, 'chat_burst': '1', 'global_rate': global_rate,
+        },
+        'Bitrix24': {'webhook': f'{bitrix_url}/rest/1/benchmark/'},
+        'System': {'db': 'sqlite:///bitrix24deals.db'},
+    }
+    for option in extra:
+        section, _, rest = option.partition('.')
+        key, _, value = rest.partition('=')
+        settings.setdefault(section, {})[key] = value
+    with open(os.path.join(work_dir, 'settings.conf'), 'w') as file:
+        for section, values in settings.items():
+            file.write(f'[{section}]\n')
+            for key, value in values.items():
+                file.write(f'{key} = {value}\n')
+            file.write('\n')
+    with open(os.path.join(work_dir, 'category_id.list'), 'w') as file:
+        for index, category_id in enumerate(CATEGORIES):
+            file.write(f'{category_id}=-100{index:010}#Категория {category_id}\n')
+    with open(os.path.join(work_dir, 'telegram_id.list'), 'w') as file:
+        file.write('1=1000001#Имя1 Фамилия-1\n')
+
+
+def child(args):
+    """
+    Один цикл синхронизации в отдельном процессе, результат — JSON в stdout
+    """
+    sys.path.insert(0, ROOT)
+    from telebot import apihelper
+    apihelper.API_URL = args.telegram_url + '/bot{0}/{1}'
+    import Bitrix24toTlgrm
+
+    class QueryCounter(logging.Handler):
+        queries = 0
+
+        def emit(self, record):
+            QueryCounter.queries += 1
+
+    peewee_logger = logging.getLogger('peewee')
+    peewee_logger.addHandler(QueryCounter())
+    peewee_logger.setLevel(logging.DEBUG)
+    peewee_logger.propagate = False
+
+    config = Bitrix24toTlgrm.Conf()
+    Bitrix24toTlgrm.enable_metrics(config)
+    started = perf_counter()
+    parser = Bitrix24toTlgrm.Bitrix24Parser(config)
+    init_time = perf_counter() - started
+    QueryCounter.queries = 0
+    started = perf_counter()
+    parser.run()
+    run_time = perf_counter() - started
+    parser.close()
+    print(json.dumps({
+        'init_time': round(init_time, 4),
+        'wall_time': round(run_time, 4),
+        'sql_queries': QueryCounter.queries,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }))
+
+
+def run_child(home, telegram_url):
+    env = dict(os.environ, HOME=home)
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', '--telegram-url', telegram_url],
+        env=env, capture_output=True, text=True,
+    )
+    if process.returncode:
+        raise RuntimeError(process.stderr)
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def run_scenario(args, size, scenario):
+    portal = Portal(size)
+    counters = Counters()
+    bitrix = FakeServer(BitrixHandler, portal, counters, latency=args.bitrix_latency / 1000)
+    telegram = FakeServer(
+        TelegramHandler, portal, counters, latency=args.telegram_latency / 1000, rate_429=args.telegram_429,
+    )
+    bitrix_url = bitrix.start()
+    telegram_url = telegram.start()
+    try:
+        with tempfile.TemporaryDirectory() as home:
+            write_config(home, bitrix_url, args.telegram_limits, args.option)
+            if scenario != 'cold':
+                run_child(home, telegram_url)
+            if scenario == 'churn':
+                portal.churn(args.churn)
+            before = counters.snapshot()
+            result = run_child(home, telegram_url)
+            after = counters.snapshot()
+    finally:
+        bitrix.shutdown()
+        telegram.shutdown()
+    for name in ('rest_http', 'rest_commands', 'telegram', 'telegram_429'):
+        result[name] = after.get(name, 0) - before.get(name, 0)
+    return result
+
+
+def check_regressions(results, baseline, tolerance):
+    failures = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        for metric in ('wall_time', 'rest_http', 'telegram', 'sql_queries', 'peak_rss_mb'):
+            limit = expected[metric] * (1 + tolerance)
+            if metric in ('rest_http', 'telegram', 'sql_queries'):
+                # Счётчики детерминированы, допуск нужен только для времени и памяти
+                limit = expected[metric]
+            if result[metric] > limit:
+                failures.append(f'{key}: {metric} {result[metric]} > {expected[metric]}')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='открытых сделок на портале')
+    parser.add_argument('--scenarios', nargs='+', default=['cold', 'steady', 'churn'],
+                        choices=['cold', 'steady', 'churn'])
+    parser.add_argument('--churn', type=float, default=0.05, help='доля изменившихся сделок в сценарии churn')
+    parser.add_argument('--bitrix-latency', type=float, default=0, help='задержка ответа Битрикс24, мс')
+    parser.add_argument('--telegram-latency', type=float, default=0, help='задержка ответа Телеграма, мс')
+    parser.add_argument('--telegram-429', type=float, default=0, help='доля ответов 429 от Телеграма')
+    parser.add_argument('--telegram-limits', action='store_true', help='оставить реальные лимиты отправки')
+    parser.add_argument('--option', action='append', default=[],
+                        help='дополнительная настройка в виде Раздел.ключ=значение, например System.sync_mode=incremental')
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--check', metavar='FILE', help='завершиться с ошибкой при регрессии относительно FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='допуск по времени и памяти')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--telegram-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+    results = {}
+    header = f'{"scenario":>8} {"deals":>7} {"wall, s":>8} {"REST http":>9} {"REST cmd":>8} ' \
+             f'{"telegram":>8} {"429":>5} {"SQL":>7} {"RSS, MB":>8}'
+    print(header)
+    for size in args.sizes:
+        for scenario in args.scenarios:
+            result = run_scenario(args, size, scenario)
+            results[f'{scenario}-{size}'] = result
+            print(f'{scenario:>8} {size:>7} {result["wall_time"]:>8.3f} {result["rest_http"]:>9} '
+                  f'{result["rest_commands"]:>8} {result["telegram"]:>8} {result["telegram_429"]:>5} '
+                  f'{result["sql_queries"]:>7} {result["peak_rss_mb"]:>8}')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.check:
+        with open(args.check) as file:
+            failures = check_regressions(results, json.load(file), args.tolerance)
+        for failure in failures:
+            print(f'Регрессия: {failure}')
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Имитация исходящего вебхука Битрикс24: отправляет события по сделкам
+в локальный приёмник режима --push в том же формате, что и портал.
+
+Пример: python tools/fake_events.py --token secret --event ONCRMDEALUPDATE 15 15 15 16
+"""
+
+import argparse
+import requests
+from time import time, sleep
+
+
+def post_event(url, token, event, deal_id, domain='example.bitrix24.ru'):
+    response = requests.post(url, data={
+        'event': event,
+        'data[FIELDS][ID]': str(deal_id),
+        'ts': str(int(time())),
+        'auth[domain]': domain,
+        'auth[client_endpoint]': f'https://{domain}/rest/',
+        'auth[server_endpoint]': 'https://oauth.bitrix.info/rest/',
+        'auth[member_id]': '0' * 32,
+        'auth[application_token]': token,
+    })
+    return response.status_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('deal_ids', type=int, nargs='+')
+    parser.add_argument('--url', default='http://127.0.0.1:8080/')
+    parser.add_argument('--token', required=True, help='application_token из настроек вебхука')
+    parser.add_argument('--event', default='ONCRMDEALUPDATE',
+                        choices=['ONCRMDEALADD', 'ONCRMDEALUPDATE', 'ONCRMDEALDELETE'])
+    parser.add_argument('--pause', type=float, default=0, help='пауза между событиями, секунд')
+    args = parser.parse_args()
+    for deal_id in args.deal_ids:
+        print(deal_id, post_event(args.url, args.token, args.event, deal_id))
+        sleep(args.pause)
+
+
+if __name__ == '__main__':
+    main()